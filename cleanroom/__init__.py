@@ -10,5 +10,21 @@ from cleanroom.factory import (
         create_scheduler,
         create_instances_under_scheduler,
         get_instances_under_scheduler,
+        close,
+        save_snapshot,
         CleanroomArgs,
 )
+from cleanroom.profiling import (
+        start_profiling,
+        stop_profiling,
+        profile,
+)
+from cleanroom.shared import (
+        create_shared_resource,
+        register_shared_resource,
+)
+from cleanroom.daemon import (
+        CleanroomServer,
+        connect_instance,
+        connect_scheduler,
+)
@@ -0,0 +1,3 @@
+from cleanroom.daemon import main
+
+main()
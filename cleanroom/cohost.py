@@ -0,0 +1,74 @@
+import threading
+from multiprocessing import Process, Manager
+
+from cleanroom.worker import (
+        CleanroomWorker,
+        unpack_cleanroom_args,
+        create_manager_channel,
+        start_proc,
+)
+
+
+class CleanroomCoHostProcess(Process):
+
+    def __init__(
+            self,
+            instance_cls,
+            args,
+            kwargs,
+            channels,
+            cpu_affinities,
+            thread_limit=None,
+            snapshot_path=None,
+    ):
+        super().__init__()
+        self.manager = None
+        self.open_slots = len(channels)
+
+        self.workers = [
+                CleanroomWorker(instance_cls, args, kwargs, in_queue, out_queue, cpu_affinity,
+                                thread_limit, snapshot_path)
+                for (in_queue, out_queue), cpu_affinity in zip(channels, cpu_affinities)
+        ]
+
+    def run(self):
+        # One serving thread per instance. A failed instance only stops its own thread,
+        # the process exits after all the instances are stopped.
+        threads = [threading.Thread(target=worker.run) for worker in self.workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def __repr__(self):
+        return f'<PID={self.pid}, {super().__repr__()}>'
+
+
+def create_cohost_proc_channels(
+        instance_cls,
+        slots,
+        cleanroom_args=None,
+        cpu_affinities=None,
+        thread_limit=None,
+        snapshot_path=None,
+):
+    args, kwargs = unpack_cleanroom_args(cleanroom_args)
+
+    if cpu_affinities is None:
+        cpu_affinities = [None] * slots
+
+    # All the channels are served by the same Manager.
+    mgr = Manager()
+    channels = [create_manager_channel(mgr) for _ in range(slots)]
+
+    proc = CleanroomCoHostProcess(
+            instance_cls,
+            args,
+            kwargs,
+            [(in_queue, out_queue) for in_queue, out_queue, _, _ in channels],
+            cpu_affinities,
+            thread_limit,
+            snapshot_path,
+    )
+    start_proc(proc, mgr)
+    return proc, channels
@@ -0,0 +1,94 @@
+import os
+import logging
+import glob
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+THREAD_LIMIT_ENV_VARS = (
+        'OMP_NUM_THREADS',
+        'OPENBLAS_NUM_THREADS',
+        'MKL_NUM_THREADS',
+        'BLIS_NUM_THREADS',
+        'VECLIB_MAXIMUM_THREADS',
+        'NUMEXPR_NUM_THREADS',
+)
+
+
+def apply_resource_limits(cpu_affinity, thread_limit):
+    # Return the limiter of threadpoolctl (if any), which should be kept alive by the caller.
+    if cpu_affinity is not None:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpu_affinity)
+        else:
+            logger.warning('apply_resource_limits: cpu_affinity is not supported in this platform.')
+
+    if thread_limit is None:
+        return None
+
+    # Must be set before the BLAS/OpenMP libraries are loaded.
+    for name in THREAD_LIMIT_ENV_VARS:
+        os.environ[name] = str(thread_limit)
+
+    try:
+        from threadpoolctl import threadpool_limits  # type: ignore
+    except ImportError:
+        return None
+    # For the libraries already loaded by the parent process.
+    return threadpool_limits(limits=thread_limit)
+
+
+def get_available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _parse_cpulist(text):
+    # Format: "0-3,8-11".
+    cpus = []
+    for segment in text.strip().split(','):
+        if not segment:
+            continue
+        if '-' in segment:
+            begin, end = segment.split('-')
+            cpus.extend(range(int(begin), int(end) + 1))
+        else:
+            cpus.append(int(segment))
+    return cpus
+
+
+def _get_numa_nodes(cpus):
+    available = set(cpus)
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')):
+        with open(path, encoding='ascii') as fin:
+            node_cpus = [cpu for cpu in _parse_cpulist(fin.read()) if cpu in available]
+        if node_cpus:
+            nodes.append(node_cpus)
+    return nodes or [cpus]
+
+
+def _split_cpus(cpus, num):
+    if num >= len(cpus):
+        # More instances than CPUs, share the CPUs.
+        return [{cpus[idx % len(cpus)]} for idx in range(num)]
+    return [set(cpus[idx * len(cpus) // num:(idx + 1) * len(cpus) // num]) for idx in range(num)]
+
+
+def plan_cpu_affinity(instances, strategy):
+    cpus = get_available_cpus()
+    if strategy == 'auto':
+        return _split_cpus(cpus, instances)
+
+    # Spread the instances across the NUMA nodes, then split the CPUs of each node.
+    nodes = _get_numa_nodes(cpus)
+    node_instances = [list(range(idx, instances, len(nodes))) for idx in range(len(nodes))]
+
+    cpu_affinities = [None] * instances
+    for node_cpus, instance_indices in zip(nodes, node_instances):
+        if not instance_indices:
+            continue
+        for instance_idx, group in zip(instance_indices,
+                                       _split_cpus(node_cpus, len(instance_indices))):
+            cpu_affinities[instance_idx] = group
+    return cpu_affinities
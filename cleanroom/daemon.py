@@ -0,0 +1,597 @@
+import sys
+import os
+import logging
+import pickle
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+import itertools
+import inspect
+import importlib
+import argparse
+import signal
+
+from cleanroom import factory, worker
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# Frame: 8-byte payload size + pickled payload.
+_FRAME_HEADER = struct.Struct('!Q')
+
+# Reject the frames that are obviously broken, instead of allocating the buffer.
+MAX_FRAME_SIZE = 1 << 30
+
+DEFAULT_POOL_SIZE = 8
+
+
+class _StaleConnection(Exception):
+    pass
+
+
+def _send_frame(sock, obj):
+    payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_FRAME_HEADER.pack(len(payload)))
+    sock.sendall(payload)
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        num = sock.recv_into(view[received:], size - received)
+        if num == 0:
+            raise EOFError('Connection closed.')
+        received += num
+    return buf
+
+
+def _recv_frame(sock):
+    size, = _FRAME_HEADER.unpack(_recv_exactly(sock, _FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f'Frame size {size} exceeds MAX_FRAME_SIZE={MAX_FRAME_SIZE}.')
+    return pickle.loads(_recv_exactly(sock, size))
+
+
+def _wrap_exception(exception):
+    _, _, traceback_obj = sys.exc_info()
+    wrapped = worker.ExceptionWrapper(exception, traceback_obj)
+    try:
+        pickle.dumps(wrapped)
+    except Exception:  # pylint: disable=broad-except
+        wrapped = worker.ExceptionWrapper(RuntimeError(repr(exception)), None)
+    return wrapped
+
+
+class _CleanroomRequestHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        # The generators created through this connection, closed with the connection.
+        self.generator_ids = set()
+        self.server.cleanroom_server._register_connection(self.request)  # type: ignore  # pylint: disable=protected-access
+
+    def finish(self):
+        cleanroom_server = self.server.cleanroom_server  # type: ignore
+        cleanroom_server._close_generators(self.generator_ids)  # pylint: disable=protected-access
+        cleanroom_server._unregister_connection(self.request)  # pylint: disable=protected-access
+
+    def handle(self):
+        cleanroom_server = self.server.cleanroom_server  # type: ignore
+        while True:
+            try:
+                request = _recv_frame(self.request)
+            except (EOFError, ConnectionError):
+                logger.debug('_CleanroomRequestHandler.handle: connection closed')
+                break
+            except ValueError:
+                logger.warning('_CleanroomRequestHandler.handle: invalid frame, closing connection')
+                break
+
+            response = cleanroom_server.dispatch(request, self.generator_ids)
+            try:
+                try:
+                    _send_frame(self.request, response)
+                except (pickle.PickleError, AttributeError, TypeError) as exception:
+                    _send_frame(self.request, (False, _wrap_exception(exception)))
+            except OSError:
+                logger.debug('_CleanroomRequestHandler.handle: connection closed when sending')
+                break
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    cleanroom_server = None
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+
+    class _ThreadingUnixStreamServer(socketserver.ThreadingUnixStreamServer):  # type: ignore
+        daemon_threads = True
+        cleanroom_server = None
+
+else:
+    _ThreadingUnixStreamServer = None  # type: ignore  # pylint: disable=invalid-name
+
+
+class CleanroomServer:
+
+    def __init__(self, address):
+        # Unix-domain socket path or (host, port).
+        self.address = address
+        self.targets = {}
+
+        self.generators = {}
+        self.generator_ids = itertools.count()
+        self.generators_lock = threading.Lock()
+        # Closing a hosted generator waits for the hosted instance, done in the background.
+        self.closing_generators = queue.Queue()
+        self.generator_closer = None
+
+        self.server = None
+        self.thread = None
+
+        # The sockets of the connections being handled.
+        self.connections = set()
+        self.connections_cond = threading.Condition()
+
+    def _register_connection(self, sock):
+        with self.connections_cond:
+            self.connections.add(sock)
+
+    def _unregister_connection(self, sock):
+        with self.connections_cond:
+            self.connections.discard(sock)
+            self.connections_cond.notify_all()
+
+    def host(self, name, proxy_or_scheduler):
+        self.targets[name] = proxy_or_scheduler
+
+    def dispatch(self, request, generator_ids=None):
+        method_name = None
+        try:
+            name, method_name, args, kwargs = request
+            if method_name in ('_crw_generator_next', '_crw_generator_close'):
+                try:
+                    return True, getattr(self, method_name)(*args, **kwargs)
+                finally:
+                    if generator_ids is not None:
+                        # Forget the generators exhausted or closed.
+                        with self.generators_lock:
+                            generator_ids.intersection_update(self.generators)
+
+            if name not in self.targets:
+                raise KeyError(f'Undefined target: {name}')
+            out = getattr(self.targets[name], method_name)(*args, **kwargs)
+
+            if inspect.isgenerator(out) or isinstance(out, factory.ProxyGenerator):
+                # Keep the generator in the daemon and stream the items back on demand.
+                with self.generators_lock:
+                    generator_id = next(self.generator_ids)
+                    self.generators[generator_id] = out
+                if generator_ids is not None:
+                    generator_ids.add(generator_id)
+                out = worker.RemoteGenerator(generator_id)
+
+            return True, out
+
+        except Exception as exception:  # pylint: disable=broad-except
+            logger.debug('CleanroomServer.dispatch: method_name=%s failed', method_name)
+            return False, _wrap_exception(exception)
+
+    def _crw_generator_next(self, generator_id, chunksize):
+        with self.generators_lock:
+            generator = self.generators.get(generator_id)
+        if generator is None:
+            return [], True
+
+        try:
+            chunk = list(itertools.islice(generator, chunksize))
+        except Exception:
+            with self.generators_lock:
+                self.generators.pop(generator_id, None)
+            raise
+
+        done = len(chunk) < chunksize
+        if done:
+            with self.generators_lock:
+                self.generators.pop(generator_id, None)
+        return chunk, done
+
+    def _crw_generator_close(self, generator_id):
+        with self.generators_lock:
+            generator = self.generators.pop(generator_id, None)
+        if generator is not None:
+            self.closing_generators.put(generator)
+
+    def _close_generators(self, generator_ids):
+        # The client is gone, nobody is going to consume or close these generators.
+        with self.generators_lock:
+            generators = [
+                    self.generators.pop(generator_id)
+                    for generator_id in generator_ids
+                    if generator_id in self.generators
+            ]
+            generator_ids.clear()
+        for generator in generators:
+            self.closing_generators.put(generator)
+
+    def _run_generator_closer(self):
+        while True:
+            generator = self.closing_generators.get()
+            if generator is None:
+                break
+            try:
+                generator.close()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('CleanroomServer._run_generator_closer: failed to close generator')
+
+    def _create_server(self):
+        if isinstance(self.address, (str, bytes, os.PathLike)):
+            path = os.fspath(self.address)
+            if _ThreadingUnixStreamServer is None:
+                raise ValueError('Unix-domain socket is not supported in this platform, '
+                                 'use (host, port) instead.')
+            if os.path.exists(path):
+                os.remove(path)
+            server = _ThreadingUnixStreamServer(path, _CleanroomRequestHandler)
+        else:
+            server = _ThreadingTCPServer(tuple(self.address), _CleanroomRequestHandler)
+            # Resolve port 0.
+            self.address = server.server_address
+
+        server.cleanroom_server = self
+
+        self.generator_closer = threading.Thread(target=self._run_generator_closer, daemon=True)
+        self.generator_closer.start()
+        return server
+
+    def serve_forever(self):
+        self.server = self._create_server()
+        logger.info('CleanroomServer.serve_forever: serving on %s', self.address)
+        self.server.serve_forever()
+
+    def start(self):
+        self.server = self._create_server()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.debug('CleanroomServer.start: serving on %s', self.address)
+
+    def close(self, timeout=factory.DEFAULT_CLOSE_TIMEOUT):
+        if self.server is None:
+            return
+        deadline = time.monotonic() + timeout
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+
+        # Stop the handlers from reading further requests, the in-flight responses are still sent.
+        with self.connections_cond:
+            connections = list(self.connections)
+        for sock in connections:
+            try:
+                sock.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
+        with self.connections_cond:
+            if not self.connections_cond.wait_for(
+                    lambda: not self.connections,
+                    max(0, deadline - time.monotonic()),
+            ):
+                logger.warning(
+                        'CleanroomServer.close: %s connections still busy after %s seconds',
+                        len(self.connections),
+                        timeout,
+                )
+
+        # The generators closed by the handlers are queued before the stop signal.
+        self.closing_generators.put(None)
+        self.generator_closer.join(max(0, deadline - time.monotonic()))
+        if self.generator_closer.is_alive():
+            logger.warning('CleanroomServer.close: generator closer still busy after %s seconds',
+                           timeout)
+
+        if isinstance(self.address, (str, bytes, os.PathLike)):
+            path = os.fspath(self.address)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_obj):
+        self.close()
+
+
+class ConnectionPool:
+
+    def __init__(self, address, size=DEFAULT_POOL_SIZE, timeout=None):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if isinstance(self.address, (str, bytes, os.PathLike)):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(os.fspath(self.address))
+        else:
+            sock = socket.create_connection(tuple(self.address))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.timeout)
+        return sock
+
+    def _is_stale(self, sock):
+        # Nothing should be readable from an idle connection, unless it has been closed by the
+        # daemon (EOF) or the previous exchange was broken.
+        sock.settimeout(0)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        finally:
+            sock.settimeout(self.timeout)
+        return True
+
+    def _acquire(self, blocking, reuse):
+        while reuse:
+            if not self.lock.acquire(blocking):
+                raise RuntimeError('The connection pool is busy.')
+            try:
+                sock = self.idle.pop() if self.idle else None
+            finally:
+                self.lock.release()
+            if sock is None:
+                break
+            if not self._is_stale(sock):
+                return sock, True
+            logger.debug('ConnectionPool._acquire: drop stale connection')
+            sock.close()
+        return self._connect(), False
+
+    def release(self, sock):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(sock)
+                return
+        sock.close()
+
+    def _request(self, obj, blocking, reuse):
+        sock, reused = self._acquire(blocking, reuse)
+        try:
+            try:
+                _send_frame(sock, obj)
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as exception:
+                if reused:
+                    raise _StaleConnection() from exception
+                raise
+            # The request might have been dispatched from here on, never retry.
+            return _recv_frame(sock), sock
+        except BaseException:
+            # The state of the connection is unknown.
+            sock.close()
+            raise
+
+    def request_and_hold(self, obj, blocking=True):
+        # Return the response and the connection, the caller should release the connection.
+        try:
+            try:
+                return self._request(obj, blocking, reuse=True)
+            except _StaleConnection:
+                # The idle connection was closed by the daemon (e.g. restarted) while sending, an
+                # incomplete frame is never dispatched, retry once on a fresh connection.
+                logger.debug('ConnectionPool.request: stale connection, retry')
+                return self._request(obj, blocking, reuse=False)
+        except socket.timeout:
+            raise factory.TimeoutException(f'Timeout (timeout={self.timeout}) when requesting.')
+
+    def request(self, obj, blocking=True):
+        response, sock = self.request_and_hold(obj, blocking)
+        self.release(sock)
+        return response
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for sock in idle:
+            sock.close()
+
+
+class ClientCall:
+
+    def __init__(self, pool, name, method_name, generator_chunksize):
+        self.pool = pool
+        self.name = name
+        self.method_name = method_name
+        self.generator_chunksize = generator_chunksize
+
+    def __call__(self, *args, **kwargs):
+        (good, out), sock = self.pool.request_and_hold((self.name, self.method_name, args, kwargs))
+        if good and isinstance(out, worker.RemoteGenerator):
+            # The daemon closes the generator with the connection creating it, keep the connection
+            # until the generator is done.
+            return factory.ProxyGenerator(
+                    PinnedClientCall(self.pool, sock, self.name),
+                    out.generator_id,
+                    self.generator_chunksize,
+            )
+
+        self.pool.release(sock)
+        if not good:
+            out.raise_again()
+        return out
+
+
+class PinnedClientCall:
+
+    def __init__(self, pool, sock, name):
+        self.pool = pool
+        self.sock = sock
+        self.name = name
+        self.lock = threading.Lock()
+
+    def _send(self, method_name, args, kwargs, blocking=True):
+        if not self.lock.acquire(blocking):
+            raise RuntimeError(
+                    f'The connection is busy when calling {method_name} without blocking.')
+
+        try:
+            if self.sock is None:
+                raise RuntimeError('The connection has been released.')
+            if not blocking and method_name == '_crw_generator_close':
+                # Called in GC, never wait for the daemon. Dropping the connection closes the
+                # generator in the daemon.
+                self.sock.close()
+                self.sock = None
+                return None
+            try:
+                _send_frame(self.sock, (self.name, method_name, args, kwargs))
+                good, out = _recv_frame(self.sock)
+            except socket.timeout:
+                self.sock.close()
+                self.sock = None
+                raise factory.TimeoutException(
+                        f'Timeout (timeout={self.pool.timeout}) when calling {method_name}.')
+            except BaseException:
+                # The generator is closed by the daemon with the connection.
+                self.sock.close()
+                self.sock = None
+                raise
+
+            if method_name == '_crw_generator_close' or not good or out[1]:
+                # The generator is gone in the daemon, the connection can be reused.
+                self.pool.release(self.sock)
+                self.sock = None
+        finally:
+            self.lock.release()
+
+        if not good:
+            out.raise_again()
+        return out
+
+
+CLEANROOM_CLIENT_PROXY_CRW = {
+        '_crw_pool',
+        '_crw_name',
+        '_crw_generator_chunksize',
+        '_crw_cached_client_call',
+}
+
+
+class CleanroomClientProxy:
+
+    def __init__(self, pool, name, generator_chunksize):
+        self._crw_pool = pool
+        self._crw_name = name
+        self._crw_generator_chunksize = generator_chunksize
+        self._crw_cached_client_call = {}
+
+    def __getattribute__(self, name):
+        if name in CLEANROOM_CLIENT_PROXY_CRW:
+            return object.__getattribute__(self, name)
+
+        if name not in self._crw_cached_client_call:
+            self._crw_cached_client_call[name] = ClientCall(
+                    self._crw_pool,
+                    self._crw_name,
+                    name,
+                    self._crw_generator_chunksize,
+            )
+        return self._crw_cached_client_call[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_obj):
+        self._crw_pool.close()
+
+
+def connect_instance(
+        address,
+        name,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=None,
+        generator_chunksize=factory.DEFAULT_GENERATOR_CHUNKSIZE,
+):
+    pool = ConnectionPool(address, pool_size, timeout)
+    return CleanroomClientProxy(pool, name, generator_chunksize)
+
+
+def connect_scheduler(
+        address,
+        name,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=None,
+        generator_chunksize=factory.DEFAULT_GENERATOR_CHUNKSIZE,
+):
+    # The scheduler is addressed the same as an instance, the selection happens in the daemon.
+    return connect_instance(address, name, pool_size, timeout, generator_chunksize)
+
+
+def _load_cls(path):
+    module_name, _, cls_name = path.partition(':')
+    return getattr(importlib.import_module(module_name), cls_name)
+
+
+def _parse_address(text):
+    if ':' in text and not text.startswith(('/', '.')):
+        host, _, port = text.rpartition(':')
+        return host, int(port)
+    return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cleanroom')
+    parser.add_argument('--bind', required=True, help='Unix-domain socket path or HOST:PORT.')
+    parser.add_argument(
+            '--instance',
+            action='append',
+            default=[],
+            help='NAME=MODULE:CLASS, host one instance.',
+    )
+    parser.add_argument(
+            '--scheduler',
+            action='append',
+            default=[],
+            help='NAME=MODULE:CLASS:INSTANCES, host a scheduler.',
+    )
+    parser.add_argument('--scheduler-type', default='random_access')
+    parser.add_argument('--timeout', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = CleanroomServer(_parse_address(args.bind))
+    for spec in args.instance:
+        name, _, cls_path = spec.partition('=')
+        server.host(name, factory.create_instance(_load_cls(cls_path), timeout=args.timeout))
+
+    for spec in args.scheduler:
+        name, _, cls_spec = spec.partition('=')
+        cls_path, _, instances = cls_spec.rpartition(':')
+        scheduler = factory.create_scheduler(int(instances), args.scheduler_type)
+        factory.create_instances_under_scheduler(
+                scheduler,
+                _load_cls(cls_path),
+                timeout=args.timeout,
+        )
+        server.host(name, scheduler)
+
+    # Clean up the instances and the socket on SIGTERM as well.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        for target in server.targets.values():
+            factory.close(target)
@@ -1,17 +1,25 @@
-import sys
 import os
 import logging
-import pickle
-import traceback
 import random
 import itertools
+import collections
 from multiprocessing import Process, Manager
 import queue
 import time
-from concurrent.futures import ThreadPoolExecutor
-
-import tblib.pickling_support
-tblib.pickling_support.install()
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from cleanroom.worker import (
+        CleanroomWorker,
+        RemoteGenerator,
+        CLEANROOM_PROCESS_CONTROL,
+        unpack_cleanroom_args,
+        create_manager_channel,
+        start_proc,
+)
+from cleanroom.subinterpreter import resolve_backend, create_interpreter_channel
+from cleanroom.cohost import create_cohost_proc_channels
+from cleanroom.cpu import get_available_cpus, plan_cpu_affinity
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -23,119 +31,134 @@ class CleanroomArgs:
         self.kwargs = kwargs
 
 
-class ExceptionWrapper:
+class TimeoutException(Exception):
+    pass
 
-    def __init__(self, exception, traceback_obj):
-        self.exception = exception
-        self.traceback_obj = traceback_obj
 
-    def raise_again(self):
-        exception = self.exception
-        if self.traceback_obj is not None:
-            exception = self.exception.with_traceback(self.traceback_obj)
-        raise exception
+DEFAULT_GENERATOR_CHUNKSIZE = 64
 
 
-class TimeoutException(Exception):
-    pass
+class CleanroomProcess(CleanroomWorker, Process):
 
+    def __init__(
+            self,
+            instance_cls,
+            args,
+            kwargs,
+            in_queue,
+            out_queue,
+            cpu_affinity=None,
+            thread_limit=None,
+            snapshot_path=None,
+    ):
+        Process.__init__(self)
+        # The Manager serving the channel, attached after starting the process.
+        self.manager = None
+        # Number of the proxies not yet closed.
+        self.open_slots = 1
+        CleanroomWorker.__init__(self, instance_cls, args, kwargs, in_queue, out_queue,
+                                 cpu_affinity, thread_limit, snapshot_path)
 
-class CleanroomProcess(Process):
+    def __repr__(self):
+        return f'<PID={self.pid}, {Process.__repr__(self)}>'
 
-    def __init__(self, instance_cls, args, kwargs, in_queue, out_queue):
-        super().__init__()
 
-        self.instance_cls = instance_cls
-        self.instance = None
-        self.args = args
-        self.kwargs = kwargs
+def create_proc_channel(
+        instance_cls,
+        cleanroom_args=None,
+        backend='process',
+        cpu_affinity=None,
+        thread_limit=None,
+        snapshot_path=None,
+):
+    args, kwargs = unpack_cleanroom_args(cleanroom_args)
 
-        self.in_queue = in_queue
-        self.out_queue = out_queue
+    backend = resolve_backend(backend)
+    if backend == 'subinterpreter':
+        if cpu_affinity is not None or thread_limit is not None:
+            # Both are process-wide settings.
+            logger.warning('create_proc_channel: cpu_affinity and thread_limit are ignored '
+                           'by the subinterpreter backend.')
 
-    def _exception_handler(self, action, in_queue_popped):
-        try:
-            out = action(in_queue_popped)
-            self.out_queue.put((True, out))
+        mgr = None
+        proc, in_queue, out_queue, state, lock = create_interpreter_channel(
+                instance_cls, args, kwargs, snapshot_path)
 
-        except Exception as exception:  # pylint: disable=broad-except
-            _, _, traceback_obj = sys.exc_info()
-            wrapped = ExceptionWrapper(exception, traceback_obj)
+    else:
+        mgr = Manager()
+        in_queue, out_queue, state, lock = create_manager_channel(mgr)
+        proc = CleanroomProcess(instance_cls, args, kwargs, in_queue, out_queue, cpu_affinity,
+                                thread_limit, snapshot_path)
 
-            try:
-                pickle.dumps(wrapped)
-            except pickle.PickleError:
-                # Cannot pickle, mock with Built-in excpetion.
-                traceback_lines = ['Traceback (most recent call last):\n']
-                traceback_lines.extend(traceback.format_tb(traceback_obj))
-                text = ''.join(traceback_lines)
-                wrapped = ExceptionWrapper(RuntimeError(text), None)
-
-            self.out_queue.put((False, wrapped))
-            sys.exit(-1)
-
-    def _initialize(self, in_queue_popped):  # pylint: disable=unused-argument
-        logger.debug('CleanroomProcess._initialize: proc=%s begin', self)
-        self.instance = self.instance_cls(*self.args, **self.kwargs)
-        logger.debug('CleanroomProcess._initialize: proc=%s end', self)
-
-    def _step(self, in_queue_popped):
-        logger.debug('CleanroomProcess._step: proc=%s begin', self)
-        method_name, method_args, method_kwargs = in_queue_popped
-        method = getattr(self.instance, method_name)
-        ret = method(*method_args, **method_kwargs)
-        logger.debug('CleanroomProcess._step: proc=%s end', self)
-        return ret
-
-    def run(self):
-        # Initialization.
-        self._exception_handler(self._initialize, self.in_queue.get())
-
-        # Serving.
-        while True:
-            try:
-                logger.debug('CleanroomProcess.run: proc=%s waiting for in_queue.get', self)
-                obj = self.in_queue.get()
-                logger.debug('CleanroomProcess.run: proc=%s receive in_queue.get', self)
-            except EOFError:
-                logger.debug('CleanroomProcess.run: proc=%s EOFError & break', self)
-                break
-            self._exception_handler(self._step, obj)
+    start_proc(proc, mgr)
+    return proc, in_queue, out_queue, state, lock
 
-    def __repr__(self):
-        return f'<PID={self.pid}, {super().__repr__()}>'
 
+DEFAULT_CLOSE_TIMEOUT = 30
+_FORCE_KILL_JOIN_TIMEOUT = 1
+_OPEN_SLOTS_LOCK = threading.Lock()
 
-def create_proc_channel(instance_cls, cleanroom_args=None):
-    mgr = Manager()
-    in_queue = mgr.Queue(maxsize=1)
-    out_queue = mgr.Queue(maxsize=1)
-    state = mgr.Value('b', 1)
-    lock = mgr.Lock()  # pylint: disable=no-member
 
-    if cleanroom_args is None:
-        args = ()
-        kwargs = {}
-    else:
-        args = cleanroom_args.args
-        kwargs = cleanroom_args.kwargs
+class ProxyGenerator:
 
-    proc = CleanroomProcess(instance_cls, args, kwargs, in_queue, out_queue)
-    proc.daemon = True
-    proc.start()
-    logger.debug('create_proc_channel: proc=%s started.', proc)
+    def __init__(self, proxy_call, generator_id, chunksize):
+        self.proxy_call = proxy_call
+        self.generator_id = generator_id
+        self.chunksize = chunksize
+        self.buffer = collections.deque()
+        self.done = False
 
-    while not proc.is_alive():
-        logger.debug('create_proc_channel: proc=%s not alive, waiting...', proc)
-        time.sleep(0.01)
+    def __iter__(self):
+        return self
 
-    logger.debug('create_proc_channel: proc=%s is alive.', proc)
-    return proc, in_queue, out_queue, state, lock
+    def __next__(self):
+        while not self.buffer:
+            if self.done:
+                raise StopIteration
+            # Only fetch the next chunk once the previous one has been consumed.
+            chunk, self.done = self.proxy_call._send(  # pylint: disable=protected-access
+                    '_crw_generator_next',
+                    (self.generator_id, self.chunksize),
+                    {},
+            )
+            self.buffer.extend(chunk)
+        return self.buffer.popleft()
+
+    def close(self, blocking=True):
+        self.buffer.clear()
+        if self.done:
+            return
+        self.done = True
+        self.proxy_call._send(  # pylint: disable=protected-access
+                '_crw_generator_close',
+                (self.generator_id,),
+                {},
+                blocking=blocking,
+        )
+
+    def __del__(self):
+        # GC might run in the thread holding the (non-reentrant) lock, never block here.
+        # If the lock is busy, the remote generator is dropped with the worker.
+        try:
+            self.close(blocking=False)
+        except Exception:  # pylint: disable=broad-except
+            logger.debug('ProxyGenerator.__del__: failed to close generator_id=%s',
+                         self.generator_id)
 
 
 class ProxyCall:
 
-    def __init__(self, proc_repr, method_name, in_queue, out_queue, timeout, state, lock):
+    def __init__(
+            self,
+            proc_repr,
+            method_name,
+            in_queue,
+            out_queue,
+            timeout,
+            state,
+            lock,
+            generator_chunksize=DEFAULT_GENERATOR_CHUNKSIZE,
+    ):
         self.proc_repr = proc_repr
         self.method_name = method_name
         self.in_queue = in_queue
@@ -143,31 +166,44 @@ class ProxyCall:
         self.timeout = timeout
         self.state = state
         self.lock = lock
+        self.generator_chunksize = generator_chunksize
 
-    def __call__(self, *args, **kwargs):
+    def _send(self, method_name, args, kwargs, blocking=True):
         logger.debug(
-                'ProxyCall.__call__: waiting for lock proc=%s, method_name=%s, args=%s, kwargs=%s',
-                self.proc_repr, self.method_name, args, kwargs)
-        with self.lock:
+                'ProxyCall._send: waiting for lock proc=%s, method_name=%s, args=%s, kwargs=%s',
+                self.proc_repr, method_name, args, kwargs)
+        if not self.lock.acquire(blocking):
+            raise RuntimeError(f'The lock is busy when calling {method_name} without blocking.')
+
+        try:
             logger.debug(
-                    'ProxyCall.__call__: acquire lock proc=%s, method_name=%s, args=%s, kwargs=%s',
-                    self.proc_repr, self.method_name, args, kwargs)
+                    'ProxyCall._send: acquire lock proc=%s, method_name=%s, args=%s, kwargs=%s',
+                    self.proc_repr, method_name, args, kwargs)
 
             if self.state.value != 1:
                 raise RuntimeError('The process is not alive!')
 
-            self.in_queue.put((self.method_name, args, kwargs))
+            self.in_queue.put((method_name, args, kwargs))
             try:
                 good, out = self.out_queue.get(timeout=self.timeout)
             except queue.Empty:
                 raise TimeoutException(
-                        f'Timeout (timeout={self.timeout}) when calling {self.method_name}.')
+                        f'Timeout (timeout={self.timeout}) when calling {method_name}.')
 
             if not good:
                 self.state.value = 0
                 out.raise_again()
             return out
 
+        finally:
+            self.lock.release()
+
+    def __call__(self, *args, **kwargs):
+        out = self._send(self.method_name, args, kwargs)
+        if isinstance(out, RemoteGenerator):
+            return ProxyGenerator(self, out.generator_id, self.generator_chunksize)
+        return out
+
 
 def _raise_on_invalid_method_name(instance_cls, name):
     if not hasattr(instance_cls, name):
@@ -184,8 +220,13 @@ CLEANROOM_PROCESS_PROXY_CRW = {
         '_crw_timeout',
         '_crw_state',
         '_crw_lock',
+        '_crw_generator_chunksize',
         '_crw_cached_proxy_call',
         '_crw_check_instance_cls_methods',
+        '_crw_create_proxy_call',
+        '_crw_control_call',
+        '_crw_closed',
+        '_crw_close',
 }
 
 
@@ -206,6 +247,7 @@ class CleanroomProcessProxy:
             timeout,
             state,
             lock,
+            generator_chunksize=DEFAULT_GENERATOR_CHUNKSIZE,
     ):
         self._crw_instance_cls = instance_cls
         self._crw_proc = proc
@@ -214,28 +256,100 @@ class CleanroomProcessProxy:
         self._crw_timeout = timeout
         self._crw_state = state
         self._crw_lock = lock
+        self._crw_generator_chunksize = generator_chunksize
         self._crw_cached_proxy_call = {}
+        self._crw_closed = False
 
     def __getattribute__(self, name):
         if name in CLEANROOM_PROCESS_PROXY_CRW:
             return object.__getattribute__(self, name)
 
+        if self._crw_closed:
+            raise RuntimeError('The instance is closed!')
+
         if name not in self._crw_cached_proxy_call:
             _raise_on_invalid_method_name(self._crw_instance_cls, name)
-
-            self._crw_cached_proxy_call[name] = ProxyCall(
-                    proc_repr=repr(self._crw_proc),
-                    method_name=name,
-                    in_queue=self._crw_in_queue,
-                    out_queue=self._crw_out_queue,
-                    timeout=self._crw_timeout,
-                    state=self._crw_state,
-                    lock=self._crw_lock,
-            )
+            self._crw_cached_proxy_call[name] = self._crw_create_proxy_call(name)
 
         return self._crw_cached_proxy_call[name]
 
+    def _crw_create_proxy_call(self, name):
+        return ProxyCall(
+                proc_repr=repr(self._crw_proc),
+                method_name=name,
+                in_queue=self._crw_in_queue,
+                out_queue=self._crw_out_queue,
+                timeout=self._crw_timeout,
+                state=self._crw_state,
+                lock=self._crw_lock,
+                generator_chunksize=self._crw_generator_chunksize,
+        )
+
+    def _crw_control_call(self, name, *args):
+        # Call the method of CleanroomWorker instead of the hosted instance.
+        assert name in CLEANROOM_PROCESS_CONTROL
+        return self._crw_create_proxy_call(name)(*args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_obj):
+        close(self)
+
+    def _crw_close(self, deadline, graceful=True):
+        if self._crw_closed:
+            return
+        self._crw_closed = True
+
+        proc = self._crw_proc
+
+        # Ask the serving loop to stop.
+        try:
+            if graceful:
+                # Wait for the in-flight call.
+                if self._crw_lock.acquire(timeout=max(0, deadline - time.monotonic())):
+                    try:
+                        self._crw_state.value = 0
+                        self._crw_in_queue.put(None, timeout=max(0, deadline - time.monotonic()))
+                    finally:
+                        self._crw_lock.release()
+            elif proc.open_slots > 1:
+                # Don't kill the co-hosted instances.
+                self._crw_in_queue.put(None, timeout=0)
+        except Exception:  # pylint: disable=broad-except
+            logger.debug('CleanroomProcessProxy._crw_close: failed to stop proc=%s', proc)
+
+        with _OPEN_SLOTS_LOCK:
+            proc.open_slots -= 1
+            if proc.open_slots > 0:
+                logger.debug('CleanroomProcessProxy._crw_close: proc=%s is still hosting', proc)
+                return
+
+        if graceful:
+            proc.join(max(0, deadline - time.monotonic()))
+
+        if proc.exitcode is None:
+            logger.debug('CleanroomProcessProxy._crw_close: terminating proc=%s', proc)
+            proc.terminate()
+            proc.join(max(0, deadline - time.monotonic()))
+
+        if proc.exitcode is None:
+            logger.debug('CleanroomProcessProxy._crw_close: timeout & force killing proc=%s', proc)
+            proc.kill()
+            proc.join(_FORCE_KILL_JOIN_TIMEOUT)
+            if proc.exitcode is None:
+                logger.warning('CleanroomProcessProxy._crw_close: proc=%s is still running', proc)
+        else:
+            logger.debug('CleanroomProcessProxy._crw_close: proc=%s is terminated', proc)
+
+        if proc.manager is not None:
+            proc.manager.shutdown()
+            proc.manager = None
+
     def __del__(self):
+        if self._crw_closed:
+            return
+
         # Remove process in GC.
         if self._crw_proc._parent_pid != os.getpid():  # pylint: disable=protected-access
             logger.debug('CleanroomProcessProxy.__del__: killing unknown proc=%s', self._crw_proc)
@@ -244,46 +358,43 @@ class CleanroomProcessProxy:
                 getattr(self._crw_proc, 'kill')()
             return
 
-        # Normal termination.
-        logger.debug('CleanroomProcessProxy.__del__: terminating proc=%s', self._crw_proc)
-        self._crw_proc.terminate()
-
-        # Default timeout: 30s.
-        timeout = self._crw_timeout or 30
-        self._crw_proc.join(timeout)
-        if self._crw_proc.exitcode is None:
-            logger.debug('CleanroomProcessProxy.__del__: timeout & force killing proc=%s',
-                         self._crw_proc)
-            self._crw_proc.kill()
-        else:
-            logger.debug('CleanroomProcessProxy.__del__: proc=%s is terminated', self._crw_proc)
+        # Normal termination, default timeout: 30s.
+        timeout = self._crw_timeout or DEFAULT_CLOSE_TIMEOUT
+        self._crw_close(time.monotonic() + timeout, graceful=False)
 
 
 def create_instance(
         instance_cls,
         cleanroom_args=None,
         timeout=None,
+        generator_chunksize=DEFAULT_GENERATOR_CHUNKSIZE,
+        backend='process',
+        cpu_affinity=None,
+        thread_limit=None,
+        snapshot_path=None,
 ):
-    logger.debug('create_instance: instance_cls=%s, cleanroom_args=%s, timeout=%s', instance_cls,
-                 cleanroom_args, timeout)
+    logger.debug('create_instance: instance_cls=%s, cleanroom_args=%s, timeout=%s, backend=%s',
+                 instance_cls, cleanroom_args, timeout, backend)
 
-    CleanroomProcessProxy._crw_check_instance_cls_methods(instance_cls)  # pylint: disable=protected-access
+    cpu_affinity = _validate_instance_options(
+            instance_cls,
+            generator_chunksize,
+            [cpu_affinity],
+            thread_limit,
+    )[0]
 
     proc, in_queue, out_queue, state, lock = create_proc_channel(
             instance_cls,
             cleanroom_args,
+            backend,
+            cpu_affinity,
+            thread_limit,
+            snapshot_path,
     )
 
     logger.debug('create_instance: proc=%s, trigger initialization', proc)
     in_queue.put(None)
-    try:
-        logger.debug('create_instance: proc=%s, waiting for initialization...', proc)
-        good, out = out_queue.get(timeout=timeout)
-    except queue.Empty:
-        raise TimeoutException(f'Timeout (timeout={timeout}) during initialization')
-
-    if not good:
-        out.raise_again()
+    _wait_for_initialization(proc, out_queue, timeout)
 
     logger.debug('create_instance: proc=%s, initialization done', proc)
     proxy = CleanroomProcessProxy(
@@ -294,24 +405,181 @@ def create_instance(
             timeout,
             state,
             lock,
+            generator_chunksize,
     )
     logger.debug('create_instance: proxy=%s has been created for proc=%s', proxy, proc)
     return proxy
 
 
+def _validate_instance_options(instance_cls, generator_chunksize, cpu_affinities, thread_limit):
+    if generator_chunksize < 1:
+        raise ValueError(f'Invalid generator_chunksize: {generator_chunksize}')
+    if isinstance(thread_limit, str) or any(isinstance(cpus, str) for cpus in cpu_affinities):
+        # The plans are made across the instances.
+        raise ValueError(
+                "'auto' and 'numa' are only supported by create_instances_under_scheduler, "
+                'pass a CPU set and an int instead.')
+    if thread_limit is not None and thread_limit < 1:
+        raise ValueError(f'Invalid thread_limit: {thread_limit}')
+
+    normalized_cpu_affinities = []
+    for cpu_affinity in cpu_affinities:
+        if cpu_affinity is not None:
+            cpu_affinity = set(cpu_affinity)
+            if not cpu_affinity:
+                raise ValueError('cpu_affinity should not be empty.')
+        normalized_cpu_affinities.append(cpu_affinity)
+
+    CleanroomProcessProxy._crw_check_instance_cls_methods(instance_cls)  # pylint: disable=protected-access
+    return normalized_cpu_affinities
+
+
+def _wait_for_initialization(proc, out_queue, timeout):
+    try:
+        logger.debug('_wait_for_initialization: proc=%s, waiting for initialization...', proc)
+        good, out = out_queue.get(timeout=timeout)
+    except queue.Empty:
+        raise TimeoutException(f'Timeout (timeout={timeout}) during initialization')
+
+    if not good:
+        out.raise_again()
+
+
+def create_cohosted_instances(
+        instance_cls,
+        instances,
+        cleanroom_args=None,
+        timeout=None,
+        generator_chunksize=DEFAULT_GENERATOR_CHUNKSIZE,
+        cpu_affinities=None,
+        thread_limit=None,
+        snapshot_path=None,
+):
+    logger.debug('create_cohosted_instances: instance_cls=%s, instances=%s', instance_cls,
+                 instances)
+
+    if cpu_affinities is None:
+        cpu_affinities = [None] * instances
+    elif len(cpu_affinities) != instances:
+        raise ValueError(f'cpu_affinities should contain {instances} CPU sets, '
+                         f'got {len(cpu_affinities)}')
+    cpu_affinities = _validate_instance_options(
+            instance_cls,
+            generator_chunksize,
+            cpu_affinities,
+            thread_limit,
+    )
+
+    proc, channels = create_cohost_proc_channels(
+            instance_cls,
+            instances,
+            cleanroom_args,
+            cpu_affinities,
+            thread_limit,
+            snapshot_path,
+    )
+
+    # Initialize the instances concurrently.
+    logger.debug('create_cohosted_instances: proc=%s, trigger initialization', proc)
+    for in_queue, _, _, _ in channels:
+        in_queue.put(None)
+    try:
+        for _, out_queue, _, _ in channels:
+            _wait_for_initialization(proc, out_queue, timeout)
+    except BaseException:
+        proc.kill()
+        proc.join(_FORCE_KILL_JOIN_TIMEOUT)
+        proc.manager.shutdown()
+        raise
+
+    logger.debug('create_cohosted_instances: proc=%s, initialization done', proc)
+    return [
+            CleanroomProcessProxy(
+                    instance_cls,
+                    proc,
+                    in_queue,
+                    out_queue,
+                    timeout,
+                    state,
+                    lock,
+                    generator_chunksize,
+            ) for in_queue, out_queue, state, lock in channels
+    ]
+
+
+class _NOT_SHARED:  # pylint: disable=invalid-name
+    pass
+
+
 class ProxySchedulerCall:
 
     def __init__(self, scheduler, method_name):
         self.scheduler = scheduler
         self.method_name = method_name
 
-    def __call__(self, *args, **kwargs):
+    def _call(self, *args, **kwargs):
         proxy = self.scheduler._crw_select_instance(*args, **kwargs)  # pylint: disable=protected-access
         return getattr(proxy, self.method_name)(*args, **kwargs)
 
+    def __call__(self, *args, **kwargs):
+        if not self.scheduler._crw_single_flight:  # pylint: disable=protected-access
+            return self._call(*args, **kwargs)
+
+        # Typed, so that 1 and True are not shared (like functools.lru_cache(typed=True)).
+        key = (
+                self.method_name,
+                tuple((type(arg), arg) for arg in args),
+                frozenset((name, type(val), val) for name, val in kwargs.items()),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return self._call(*args, **kwargs)
+
+        in_flight = self.scheduler._crw_in_flight  # pylint: disable=protected-access
+        in_flight_lock = self.scheduler._crw_in_flight_lock  # pylint: disable=protected-access
+
+        with in_flight_lock:
+            future = in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                in_flight[key] = future
+
+        if not leader:
+            # Share the result of the identical call in flight.
+            out = future.result()
+            if out is _NOT_SHARED:
+                return self._call(*args, **kwargs)
+            return out
+
+        try:
+            out = self._call(*args, **kwargs)
+        except BaseException as exception:
+            with in_flight_lock:
+                del in_flight[key]
+            future.set_exception(exception)
+            raise
+
+        # The result is not retained after the call.
+        with in_flight_lock:
+            del in_flight[key]
+        if isinstance(out, ProxyGenerator):
+            # An iterator cannot be shared, the followers should issue their own calls.
+            future.set_result(_NOT_SHARED)
+        else:
+            future.set_result(out)
+        return out
+
 
 CLEANROOM_PROCESS_PROXY_SCHEDULER_CRW = {
         '_crw_instances',
+        '_crw_backend',
+        '_crw_instances_per_process',
+        '_crw_single_flight',
+        '_crw_in_flight',
+        '_crw_in_flight_lock',
+        '_crw_shared_resources',
         '_crw_chunksize',
         '_crw_proxies',
         '_crw_create_instances',
@@ -326,8 +594,20 @@ class CleanroomProcessProxyScheduler:
 
     PROXY_SCHEDULER_CALL_CLS = ProxySchedulerCall
 
-    def __init__(self, instances):
+    def __init__(
+            self,
+            instances,
+            backend='process',
+            single_flight=False,
+            instances_per_process=1,
+    ):
         self._crw_instances = instances
+        self._crw_backend = backend
+        self._crw_instances_per_process = instances_per_process
+        self._crw_single_flight = single_flight
+        self._crw_in_flight = {}
+        self._crw_in_flight_lock = threading.Lock()
+        self._crw_shared_resources = []
         self._crw_proxies = []
         self._crw_instance_cls = None
         self._crw_cached_proxy_scheduler_call = {}
@@ -337,18 +617,83 @@ class CleanroomProcessProxyScheduler:
             instance_cls,
             cleanroom_args=None,
             timeout=None,
+            generator_chunksize=DEFAULT_GENERATOR_CHUNKSIZE,
+            cpu_affinity=None,
+            thread_limit=None,
+            snapshot_path=None,
     ):
         for name in CLEANROOM_PROCESS_PROXY_SCHEDULER_CRW:
             if hasattr(instance_cls, name):
                 raise AttributeError(f'{instance_cls} contains {name}.')
 
+        if cpu_affinity is None:
+            cpu_affinities = [None] * self._crw_instances
+        elif cpu_affinity in ('auto', 'numa'):
+            cpu_affinities = plan_cpu_affinity(self._crw_instances, cpu_affinity)
+        else:
+            cpu_affinities = list(cpu_affinity)
+            if len(cpu_affinities) != self._crw_instances:
+                raise ValueError(f'cpu_affinity should contain {self._crw_instances} CPU sets, '
+                                 f'got {len(cpu_affinities)}')
+
+        if thread_limit == 'auto':
+            default_thread_limit = max(1, len(get_available_cpus()) // self._crw_instances)
+            thread_limits = [
+                    len(cpus) if cpus is not None else default_thread_limit
+                    for cpus in cpu_affinities
+            ]
+        else:
+            thread_limits = [thread_limit] * self._crw_instances
+
         self._crw_instance_cls = instance_cls
-        for _ in range(self._crw_instances):
-            self._crw_proxies.append(create_instance(instance_cls, cleanroom_args, timeout))
+        step = self._crw_instances_per_process
+        for begin in range(0, self._crw_instances, step):
+            if step == 1:
+                proxies = [
+                        create_instance(
+                                instance_cls,
+                                cleanroom_args,
+                                timeout,
+                                generator_chunksize,
+                                self._crw_backend,
+                                cpu_affinities[begin],
+                                thread_limits[begin],
+                                snapshot_path,
+                        )
+                ]
+            else:
+                proxies = create_cohosted_instances(
+                        instance_cls,
+                        min(step, self._crw_instances - begin),
+                        cleanroom_args,
+                        timeout,
+                        generator_chunksize,
+                        cpu_affinities[begin:begin + step],
+                        # The thread limit is process-wide.
+                        thread_limits[begin],
+                        snapshot_path,
+                )
+            self._crw_proxies.extend(proxies)
+
+            if snapshot_path is not None and not os.path.exists(snapshot_path):
+                # The rest of the instances will be restored from this one.
+                try:
+                    save_snapshot(proxies[0], snapshot_path)
+                except Exception:  # pylint: disable=broad-except
+                    # Snapshot is only an optimization, fallback to __init__.
+                    logger.exception('_crw_create_instances: failed to save snapshot to %s',
+                                     snapshot_path)
+                    snapshot_path = None
 
     def _crw_select_instance(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_obj):
+        close(self)
+
     def __getattribute__(self, name):
         if name in CLEANROOM_PROCESS_PROXY_SCHEDULER_CRW:
             return object.__getattribute__(self, name)
@@ -416,12 +761,26 @@ _REGISTERED_SCHEDULERS = {
 }
 
 
-def create_scheduler(instances, scheduler_type='random_access'):
+def create_scheduler(
+        instances,
+        scheduler_type='random_access',
+        backend='process',
+        single_flight=False,
+        instances_per_process=1,
+):
     if scheduler_type not in _REGISTERED_SCHEDULERS:
         raise ValueError(f'Undefined scheduler type: {scheduler_type}')
+    if instances_per_process < 1:
+        raise ValueError(f'Invalid instances_per_process: {instances_per_process}')
+
+    backend = resolve_backend(backend)
+    if backend == 'subinterpreter' and instances_per_process > 1:
+        logger.warning('create_scheduler: instances_per_process is ignored by the subinterpreter '
+                       'backend.')
+        instances_per_process = 1
 
     scheduler_cls = _REGISTERED_SCHEDULERS[scheduler_type]
-    return scheduler_cls(instances)
+    return scheduler_cls(instances, backend, single_flight, instances_per_process)
 
 
 def create_instances_under_scheduler(
@@ -429,13 +788,63 @@ def create_instances_under_scheduler(
         instance_cls,
         cleanroom_args=None,
         timeout=None,
+        generator_chunksize=DEFAULT_GENERATOR_CHUNKSIZE,
+        cpu_affinity=None,
+        thread_limit=None,
+        snapshot_path=None,
 ):
     scheduler._crw_create_instances(  # pylint: disable=protected-access
             instance_cls,
             cleanroom_args,
             timeout,
+            generator_chunksize,
+            cpu_affinity,
+            thread_limit,
+            snapshot_path,
     )
 
 
 def get_instances_under_scheduler(scheduler):
     return scheduler._crw_proxies  # pylint: disable=protected-access
+
+
+def _get_proxies(proxy_or_scheduler):
+    if issubclass(type(proxy_or_scheduler), CleanroomProcessProxyScheduler):
+        return get_instances_under_scheduler(proxy_or_scheduler)
+    return [proxy_or_scheduler]
+
+
+def _map_proxies(proxy_or_scheduler, func):
+    proxies = _get_proxies(proxy_or_scheduler)
+    if not proxies:
+        return []
+    # Don't wait for the busy workers one by one.
+    with ThreadPoolExecutor(max_workers=len(proxies)) as pool:
+        return list(pool.map(func, proxies))
+
+
+def close(proxy_or_scheduler, timeout=DEFAULT_CLOSE_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    _map_proxies(
+            proxy_or_scheduler,
+            lambda p: p._crw_close(deadline),  # pylint: disable=protected-access
+    )
+
+    if issubclass(type(proxy_or_scheduler), CleanroomProcessProxyScheduler):
+        shared_resources = proxy_or_scheduler._crw_shared_resources  # pylint: disable=protected-access
+        while shared_resources:
+            shared_resources.pop().release()
+
+
+def save_snapshot(proxy_or_scheduler, path):
+    # All instances under a scheduler are expected to be interchangeable, pick an alive one.
+    alive_proxies = [
+            proxy for proxy in _get_proxies(proxy_or_scheduler)
+            if not proxy._crw_closed and proxy._crw_state.value == 1  # pylint: disable=protected-access
+    ]
+    if not alive_proxies:
+        raise RuntimeError('No alive instance to snapshot.')
+    proxy = alive_proxies[0]
+    out = proxy._crw_control_call('_crw_snapshot_save', os.fspath(path))  # pylint: disable=protected-access
+    if out is not None:
+        out.raise_again()
@@ -0,0 +1,60 @@
+import logging
+import time
+import pstats
+
+from cleanroom import factory
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def _try_control_call(proxy, name, *args):
+    # Skip the dead, closed or unresponsive workers, so that the healthy ones are still reachable.
+    proc = proxy._crw_proc  # pylint: disable=protected-access
+    if proxy._crw_closed:  # pylint: disable=protected-access
+        logger.warning('_try_control_call: skip closed proc=%s', proc)
+        return None
+    try:
+        return proxy._crw_control_call(name, *args)  # pylint: disable=protected-access
+    except (RuntimeError, EOFError, OSError, factory.TimeoutException) as exception:
+        logger.warning('_try_control_call: skip proc=%s, name=%s, exception=%r', proc, name,
+                       exception)
+        return None
+
+
+def _control_call_proxies(proxy_or_scheduler, name, *args):
+    # None for the skipped proxies.
+    return factory._map_proxies(  # pylint: disable=protected-access
+            proxy_or_scheduler,
+            lambda p: _try_control_call(p, name, *args),
+    )
+
+
+class _ProfileStats:
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def start_profiling(proxy_or_scheduler):
+    outs = _control_call_proxies(proxy_or_scheduler, '_crw_profile_start')
+    return all(out for out in outs if out is not None)
+
+
+def stop_profiling(proxy_or_scheduler):
+    merged = pstats.Stats()
+    for stats in _control_call_proxies(proxy_or_scheduler, '_crw_profile_stop'):
+        if stats:
+            merged.add(_ProfileStats(stats))
+    return merged
+
+
+def profile(proxy_or_scheduler, duration):
+    start_profiling(proxy_or_scheduler)
+    try:
+        time.sleep(duration)
+    finally:
+        stats = stop_profiling(proxy_or_scheduler)
+    return stats
@@ -0,0 +1,113 @@
+import os
+import mmap
+import tempfile
+
+
+def _get_shared_resource_dir():
+    # Prefer the memory-backed filesystem.
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class SharedResource:
+
+    def __init__(self, path, kind, dtype=None, shape=None, owned=False):
+        self.path = path
+        self.kind = kind
+        self.dtype = dtype
+        self.shape = shape
+        self.owned = owned
+        self.creator_pid = os.getpid()
+
+    @classmethod
+    def create(cls, obj):
+        if isinstance(obj, (str, os.PathLike)):
+            # Map the file as is.
+            return cls(os.fspath(obj), 'file')
+
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            kind = 'bytes'
+            dtype = None
+            shape = None
+        elif hasattr(obj, '__array_interface__') and hasattr(obj, 'dtype'):
+            import numpy  # type: ignore
+            obj = numpy.ascontiguousarray(obj)
+            if obj.dtype.hasobject:
+                raise ValueError('Cannot share the array of Python objects.')
+            kind = 'ndarray'
+            dtype = obj.dtype.str
+            shape = obj.shape
+        else:
+            raise TypeError(f'Cannot share {type(obj)}, should be bytes, NumPy array or path.')
+
+        fileno, path = tempfile.mkstemp(prefix='cleanroom-', dir=_get_shared_resource_dir())
+        with os.fdopen(fileno, 'wb') as fout:
+            if kind == 'ndarray':
+                obj.tofile(fout)
+            else:
+                fout.write(obj)
+        return cls(path, kind, dtype, shape, owned=True)
+
+    def attach(self):
+        with open(self.path, 'rb') as fin:
+            size = os.fstat(fin.fileno()).st_size
+            if size == 0:
+                buf = memoryview(b'')
+            else:
+                # The mapping is kept alive by the views.
+                buf = memoryview(mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ))
+
+        if self.kind == 'ndarray':
+            import numpy  # type: ignore
+            array = numpy.frombuffer(buf, dtype=numpy.dtype(self.dtype)).reshape(self.shape)
+            array.flags.writeable = False
+            return array
+        return buf
+
+    def release(self):
+        if self.owned and self.creator_pid == os.getpid() and os.path.exists(self.path):
+            os.remove(self.path)
+        self.owned = False
+
+    def __getstate__(self):
+        # Only the handle in the creator owns the file, even for the copies in the same process.
+        state = self.__dict__.copy()
+        state['owned'] = False
+        return state
+
+    def __del__(self):
+        self.release()
+
+    def __repr__(self):
+        return f'<SharedResource kind={self.kind}, path={self.path}>'
+
+
+def attach_shared_resource(shared_resource, shared_views):
+    view = shared_resource.attach()
+    # Keep the view alive, so that the id is not reused.
+    shared_views[id(view)] = (view, shared_resource)
+    return view
+
+
+def attach_shared_resources(args, kwargs, shared_views):
+    args = tuple(
+            attach_shared_resource(arg, shared_views) if isinstance(arg, SharedResource) else arg
+            for arg in args)
+    kwargs = {
+            key:
+                    attach_shared_resource(val, shared_views)
+                    if isinstance(val, SharedResource) else val for key, val in kwargs.items()
+    }
+    return args, kwargs
+
+
+def create_shared_resource(obj):
+    return SharedResource.create(obj)
+
+
+def register_shared_resource(scheduler, obj):
+    # Released when the scheduler is closed.
+    shared_resource = create_shared_resource(obj)
+    scheduler._crw_shared_resources.append(shared_resource)  # pylint: disable=protected-access
+    return shared_resource
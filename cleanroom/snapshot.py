@@ -0,0 +1,71 @@
+import os
+import pickle
+import mmap
+import threading
+
+from cleanroom.shared import attach_shared_resource
+
+
+class _SnapshotPickler(pickle.Pickler):
+
+    def __init__(self, fout, shared_views):
+        super().__init__(fout, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared_views = shared_views
+
+    def persistent_id(self, obj):  # pylint: disable=method-hidden
+        # Store the handle instead of the content of the shared resource.
+        entry = self.shared_views.get(id(obj))
+        if entry is not None and entry[0] is obj:
+            return entry[1]
+        return None
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+
+    def __init__(self, fin, shared_views):
+        super().__init__(fin)
+        self.shared_views = shared_views
+
+    def persistent_load(self, pid):  # pylint: disable=method-hidden
+        return attach_shared_resource(pid, self.shared_views)
+
+
+def dump_snapshot(instance, path, shared_views):
+    if hasattr(instance, '__getstate__'):
+        state = instance.__getstate__()
+    else:
+        # Before 3.11, the same state as pickle.
+        state = instance.__reduce_ex__(pickle.HIGHEST_PROTOCOL)[2]
+
+    # Write to a temporary file first, so that the readers never see a partial snapshot.
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as fout:
+            _SnapshotPickler(fout, shared_views).dump(state)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_snapshot(instance_cls, path, shared_views):
+    with open(path, 'rb') as fin:
+        # Unpickle from the page cache without reading the whole file into memory first.
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            state = _SnapshotUnpickler(buf, shared_views).load()
+
+    instance = instance_cls.__new__(instance_cls)
+    if hasattr(instance, '__setstate__'):
+        instance.__setstate__(state)
+        return instance
+
+    # Same as the default of pickle, (dict_state, slots_state) for the class with __slots__.
+    slots_state = None
+    if isinstance(state, tuple) and len(state) == 2:
+        state, slots_state = state
+    if state:
+        instance.__dict__.update(state)
+    if slots_state:
+        for name, value in slots_state.items():
+            setattr(instance, name, value)
+    return instance
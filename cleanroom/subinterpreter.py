@@ -0,0 +1,140 @@
+import os
+import logging
+import queue
+import threading
+import atexit
+import types
+
+from cleanroom.worker import CleanroomWorker
+
+try:
+    # New in 3.14.
+    from concurrent import interpreters  # type: ignore
+except ImportError:
+    interpreters = None  # pylint: disable=invalid-name
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def _run_cleanroom_worker(instance_cls, args, kwargs, in_queue, out_queue, snapshot_path):
+    # Entry point in the subinterpreter.
+    worker = CleanroomWorker(instance_cls,
+                             args,
+                             kwargs,
+                             in_queue,
+                             out_queue,
+                             snapshot_path=snapshot_path)
+    try:
+        worker.run()
+    except SystemExit:
+        pass
+
+
+# Kept until the serving loop stops, even if the proxy has given up waiting for it.
+_ALIVE_CLEANROOM_INTERPRETERS = set()  # type: ignore
+_ALIVE_CLEANROOM_INTERPRETERS_LOCK = threading.Lock()
+
+
+class CleanroomInterpreter:
+
+    def __init__(self, instance_cls, args, kwargs, in_queue, out_queue, snapshot_path=None):
+        self.instance_cls = instance_cls
+        self.args = args
+        self.kwargs = kwargs
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.snapshot_path = snapshot_path
+
+        self.interpreter = None
+        self.thread = None
+        self.daemon = True
+        self.manager = None
+        self.open_slots = 1
+
+        # Mimic the Process interface, the interpreter lives in the current process.
+        self.pid = os.getpid()
+        self._parent_pid = os.getpid()
+
+    def _serve(self):
+        try:
+            self.interpreter.call(
+                    _run_cleanroom_worker,
+                    self.instance_cls,
+                    self.args,
+                    self.kwargs,
+                    self.in_queue,
+                    self.out_queue,
+                    self.snapshot_path,
+            )
+        finally:
+            # Closed here instead of join, since the serving loop might stop after the close
+            # of the proxy has timed out.
+            self.interpreter.close()
+            with _ALIVE_CLEANROOM_INTERPRETERS_LOCK:
+                _ALIVE_CLEANROOM_INTERPRETERS.discard(self)
+
+    def start(self):
+        self.interpreter = interpreters.create()
+        with _ALIVE_CLEANROOM_INTERPRETERS_LOCK:
+            _ALIVE_CLEANROOM_INTERPRETERS.add(self)
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def exitcode(self):
+        if self.thread is None or self.thread.is_alive():
+            return None
+        return 0
+
+    def terminate(self):
+        # An interpreter cannot be interrupted, ask the serving loop to stop instead.
+        try:
+            self.in_queue.put_nowait(None)
+        except queue.Full:
+            logger.debug('CleanroomInterpreter.terminate: in_queue of %s is full', self)
+
+    def kill(self):
+        # Unlike a process, the busy interpreter keeps running until the in-flight call returns.
+        if self.is_alive():
+            logger.warning(
+                    'CleanroomInterpreter.kill: %s is busy and cannot be interrupted, '
+                    'it is closed once the in-flight call returns.', self)
+        self.terminate()
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def __repr__(self):
+        return f'<PID={self.pid}, CleanroomInterpreter({self.instance_cls.__name__})>'
+
+
+@atexit.register
+def _shutdown_cleanroom_interpreters():
+    with _ALIVE_CLEANROOM_INTERPRETERS_LOCK:
+        alive_interpreters = list(_ALIVE_CLEANROOM_INTERPRETERS)
+    for interpreter in alive_interpreters:
+        interpreter.terminate()
+        interpreter.join(1)
+
+
+def resolve_backend(backend):
+    if backend not in ('process', 'subinterpreter'):
+        raise ValueError(f'Undefined backend: {backend}')
+
+    if backend == 'subinterpreter' and interpreters is None:
+        logger.warning('Subinterpreter is not available, fallback to the process backend.')
+        backend = 'process'
+    return backend
+
+
+def create_interpreter_channel(instance_cls, args, kwargs, snapshot_path=None):
+    in_queue = interpreters.create_queue(maxsize=1)
+    out_queue = interpreters.create_queue(maxsize=1)
+    state = types.SimpleNamespace(value=1)
+    lock = threading.Lock()
+    proc = CleanroomInterpreter(instance_cls, args, kwargs, in_queue, out_queue, snapshot_path)
+    return proc, in_queue, out_queue, state, lock
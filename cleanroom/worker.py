@@ -0,0 +1,235 @@
+import sys
+import os
+import logging
+import pickle
+import traceback
+import itertools
+import inspect
+import cProfile
+import time
+
+import tblib.pickling_support
+
+from cleanroom.cpu import apply_resource_limits
+from cleanroom.shared import attach_shared_resources
+from cleanroom.snapshot import dump_snapshot, load_snapshot
+
+tblib.pickling_support.install()
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class ExceptionWrapper:
+
+    def __init__(self, exception, traceback_obj):
+        self.exception = exception
+        self.traceback_obj = traceback_obj
+
+    def raise_again(self):
+        exception = self.exception
+        if self.traceback_obj is not None:
+            exception = self.exception.with_traceback(self.traceback_obj)
+        raise exception
+
+
+class RemoteGenerator:
+
+    def __init__(self, generator_id):
+        self.generator_id = generator_id
+
+
+CLEANROOM_PROCESS_CONTROL = {
+        '_crw_generator_next',
+        '_crw_generator_close',
+        '_crw_profile_start',
+        '_crw_profile_stop',
+        '_crw_snapshot_save',
+}
+
+
+class CleanroomWorker:
+
+    def __init__(
+            self,
+            instance_cls,
+            args,
+            kwargs,
+            in_queue,
+            out_queue,
+            cpu_affinity=None,
+            thread_limit=None,
+            snapshot_path=None,
+    ):
+        self.instance_cls = instance_cls
+        self.instance = None
+        self.args = args
+        self.kwargs = kwargs
+        self.snapshot_path = snapshot_path
+
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+
+        self.cpu_affinity = cpu_affinity
+        self.thread_limit = thread_limit
+        self.threadpool_limiter = None
+
+        # Generators returned by the hosted methods, kept alive until exhausted or closed.
+        self.generators = {}
+        self.generator_ids = itertools.count()
+
+        self.profiler = None
+
+        # id(view) -> (view, SharedResource), for the shared resources attached by this worker.
+        self.shared_views = {}
+
+    def _exception_handler(self, action, in_queue_popped):
+        try:
+            out = action(in_queue_popped)
+            self.out_queue.put((True, out))
+
+        except Exception as exception:  # pylint: disable=broad-except
+            _, _, traceback_obj = sys.exc_info()
+            wrapped = ExceptionWrapper(exception, traceback_obj)
+
+            try:
+                pickle.dumps(wrapped)
+            except pickle.PickleError:
+                # Cannot pickle, mock with Built-in excpetion.
+                traceback_lines = ['Traceback (most recent call last):\n']
+                traceback_lines.extend(traceback.format_tb(traceback_obj))
+                text = ''.join(traceback_lines)
+                wrapped = ExceptionWrapper(RuntimeError(text), None)
+
+            self.out_queue.put((False, wrapped))
+            sys.exit(-1)
+
+    def _initialize(self, in_queue_popped):  # pylint: disable=unused-argument
+        logger.debug('CleanroomWorker._initialize: proc=%s begin', self)
+        self.threadpool_limiter = apply_resource_limits(self.cpu_affinity, self.thread_limit)
+        if self.snapshot_path is not None and os.path.exists(self.snapshot_path):
+            logger.debug('CleanroomWorker._initialize: proc=%s restore from %s', self,
+                         self.snapshot_path)
+            self.instance = load_snapshot(
+                    self.instance_cls,
+                    self.snapshot_path,
+                    self.shared_views,
+            )
+        else:
+            args, kwargs = attach_shared_resources(self.args, self.kwargs, self.shared_views)
+            self.instance = self.instance_cls(*args, **kwargs)
+        logger.debug('CleanroomWorker._initialize: proc=%s end', self)
+
+    def _step(self, in_queue_popped):
+        logger.debug('CleanroomWorker._step: proc=%s begin', self)
+        method_name, method_args, method_kwargs = in_queue_popped
+        if method_name in CLEANROOM_PROCESS_CONTROL:
+            method = getattr(self, method_name)
+        else:
+            method = getattr(self.instance, method_name)
+        ret = method(*method_args, **method_kwargs)
+
+        if inspect.isgenerator(ret):
+            # Keep the generator in the worker and stream the items back on demand.
+            generator_id = next(self.generator_ids)
+            self.generators[generator_id] = ret
+            ret = RemoteGenerator(generator_id)
+
+        logger.debug('CleanroomWorker._step: proc=%s end', self)
+        return ret
+
+    def _crw_generator_next(self, generator_id, chunksize):
+        generator = self.generators.get(generator_id)
+        if generator is None:
+            return [], True
+
+        chunk = list(itertools.islice(generator, chunksize))
+        done = len(chunk) < chunksize
+        if done:
+            del self.generators[generator_id]
+        return chunk, done
+
+    def _crw_generator_close(self, generator_id):
+        generator = self.generators.pop(generator_id, None)
+        if generator is not None:
+            generator.close()
+
+    def _crw_profile_start(self):
+        if self.profiler is not None:
+            return True
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active in this worker.
+            logger.debug('CleanroomWorker._crw_profile_start: proc=%s failed to enable', self)
+            return False
+
+        self.profiler = profiler
+        return True
+
+    def _crw_profile_stop(self):
+        if self.profiler is None:
+            return {}
+
+        self.profiler.disable()
+        self.profiler.create_stats()
+        stats = self.profiler.stats  # pylint: disable=no-member
+        self.profiler = None
+        return stats
+
+    def _crw_snapshot_save(self, path):
+        # Failed snapshot should not stop the serving.
+        try:
+            dump_snapshot(self.instance, path, self.shared_views)
+        except Exception as exception:  # pylint: disable=broad-except
+            _, _, traceback_obj = sys.exc_info()
+            return ExceptionWrapper(exception, traceback_obj)
+        return None
+
+    def run(self):
+        # Initialization.
+        self._exception_handler(self._initialize, self.in_queue.get())
+
+        # Serving.
+        while True:
+            try:
+                logger.debug('CleanroomWorker.run: proc=%s waiting for in_queue.get', self)
+                obj = self.in_queue.get()
+                logger.debug('CleanroomWorker.run: proc=%s receive in_queue.get', self)
+            except EOFError:
+                logger.debug('CleanroomWorker.run: proc=%s EOFError & break', self)
+                break
+            if obj is None:
+                logger.debug('CleanroomWorker.run: proc=%s receive stop signal & break', self)
+                break
+            self._exception_handler(self._step, obj)
+
+
+def unpack_cleanroom_args(cleanroom_args):
+    if cleanroom_args is None:
+        return (), {}
+    return cleanroom_args.args, cleanroom_args.kwargs
+
+
+def create_manager_channel(mgr):
+    return (
+            mgr.Queue(maxsize=1),
+            mgr.Queue(maxsize=1),
+            mgr.Value('b', 1),
+            mgr.Lock(),  # pylint: disable=no-member
+    )
+
+
+def start_proc(proc, mgr=None):
+    proc.daemon = True
+    proc.start()
+    if mgr is not None:
+        proc.manager = mgr
+    logger.debug('start_proc: proc=%s started.', proc)
+
+    while not proc.is_alive():
+        logger.debug('start_proc: proc=%s not alive, waiting...', proc)
+        time.sleep(0.01)
+
+    logger.debug('start_proc: proc=%s is alive.', proc)
@@ -37,6 +37,11 @@ setup(
         'Programming Language :: Python :: 3.7',
     ],
     description="None",
+    entry_points={
+        'console_scripts': [
+            'cleanroom=cleanroom.daemon:main',
+        ],
+    },
     install_requires=requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
@@ -0,0 +1,286 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from cleanroom import factory, daemon
+
+
+class DummyClass:
+
+    def __init__(self, num=0):
+        self.num = num
+
+    def get(self):
+        return self.num
+
+    def inc(self):
+        self.num += 1
+        return self.num
+
+    def pid(self):
+        import os
+        return os.getpid()
+
+    def echo(self, num):
+        return num
+
+    def boom(self):
+        raise RuntimeError('something wrong.')
+
+    def count(self, num):
+        for idx in range(num):
+            yield idx
+
+    def slow(self, seconds):
+        import time
+        time.sleep(seconds)
+
+
+@pytest.fixture
+def unix_server(tmp_path):
+    server = daemon.CleanroomServer(str(tmp_path / 'cleanroom.sock'))
+    server.host('instance', factory.create_instance(DummyClass, factory.CleanroomArgs(42)))
+
+    scheduler = factory.create_scheduler(3)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+    server.host('scheduler', scheduler)
+
+    batch_scheduler = factory.create_scheduler(2, scheduler_type='batch_random_access')
+    factory.create_instances_under_scheduler(batch_scheduler, DummyClass)
+    server.host('batch_scheduler', batch_scheduler)
+
+    server.start()
+    yield server
+    server.close()
+    for target in server.targets.values():
+        factory.close(target)
+
+
+def test_connect_instance(unix_server):
+    with daemon.connect_instance(unix_server.address, 'instance', pool_size=2) as proxy:
+        assert proxy.get() == 42
+        assert proxy.inc() == 43
+        assert proxy.pid() != os.getpid()
+        assert proxy.echo({'a': [1]}) == {'a': [1]}
+
+        with pytest.raises(NotImplementedError):
+            proxy.this_does_not_exists()
+
+        num_list = list(range(200))
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            assert list(pool.map(proxy.echo, num_list)) == num_list
+        assert len(proxy._crw_pool.idle) <= 2
+
+        # Streamed through the daemon.
+        assert list(proxy.count(100)) == list(range(100))
+        gen = proxy.count(100)
+        assert next(gen) == 0
+        gen.close()
+        assert not unix_server.generators
+
+
+def test_connect_instance_error(unix_server):
+    proxy = daemon.connect_instance(unix_server.address, 'instance')
+    with pytest.raises(RuntimeError):
+        proxy.boom()
+    with pytest.raises(RuntimeError):
+        proxy.get()
+
+    proxy = daemon.connect_instance(unix_server.address, 'undefined')
+    with pytest.raises(KeyError):
+        proxy.get()
+
+
+def test_connect_scheduler(unix_server):
+    scheduler = daemon.connect_scheduler(unix_server.address, 'scheduler')
+    assert len(set(scheduler.pid() for _ in range(100))) == 3
+
+    batch_scheduler = daemon.connect_scheduler(unix_server.address, 'batch_scheduler')
+    pids = set(batch_scheduler.pid([factory.CleanroomArgs()] * 100))
+    assert len(pids) == 2
+
+
+def test_tcp_server():
+    with daemon.CleanroomServer(('127.0.0.1', 0)) as server:
+        server.host('instance', factory.create_instance(DummyClass))
+        server.start()
+
+        host, port = server.address
+        proxy = daemon.connect_instance((host, port), 'instance')
+        assert proxy.inc() == 1
+        assert proxy.inc() == 2
+
+
+def test_frame(tmp_path):
+    import socket
+    sock_a, sock_b = socket.socketpair()
+    daemon._send_frame(sock_a, b'x' * 100000)
+    assert daemon._recv_frame(sock_b) == b'x' * 100000
+    sock_a.close()
+    with pytest.raises(EOFError):
+        daemon._recv_frame(sock_b)
+
+
+def test_server_close_connections(tmp_path):
+    server = daemon.CleanroomServer(str(tmp_path / 'cleanroom.sock'))
+    server.host('instance', factory.create_instance(DummyClass))
+    server.start()
+
+    proxy = daemon.connect_instance(server.address, 'instance')
+    assert proxy.inc() == 1
+    assert len(proxy._crw_pool.idle) == 1
+
+    server.close()
+    assert not server.connections
+    # The idle connection is closed by the server, and no new connection is accepted.
+    with pytest.raises((EOFError, OSError)):
+        proxy.inc()
+
+    factory.close(server.targets['instance'])
+
+
+def test_pool_reconnect(tmp_path):
+    address = str(tmp_path / 'cleanroom.sock')
+    instance = factory.create_instance(DummyClass)
+
+    server = daemon.CleanroomServer(address)
+    server.host('instance', instance)
+    server.start()
+    proxy = daemon.connect_instance(address, 'instance')
+    assert proxy.inc() == 1
+    server.close()
+
+    # The idle connection is stale after the restart, the call is retried on a fresh connection.
+    server = daemon.CleanroomServer(address)
+    server.host('instance', instance)
+    server.start()
+    assert len(proxy._crw_pool.idle) == 1
+    assert proxy.inc() == 2
+
+    server.close()
+    factory.close(instance)
+
+
+def test_frame_too_large(unix_server):
+    import socket
+    import struct
+
+    sock_a, sock_b = socket.socketpair()
+    sock_a.sendall(struct.pack('!Q', 2**63))
+    with pytest.raises(ValueError):
+        daemon._recv_frame(sock_b)
+    sock_a.close()
+    sock_b.close()
+
+    # The daemon drops the connection and keeps serving.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(unix_server.address)
+    sock.sendall(struct.pack('!Q', 2**63))
+    assert sock.recv(1) == b''
+    sock.close()
+
+    proxy = daemon.connect_instance(unix_server.address, 'instance')
+    assert proxy.get() == 42
+
+
+def test_pool_no_retry_after_sent(tmp_path):
+    import socket
+
+    address = str(tmp_path / 'fake.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(address)
+    listener.listen(4)
+    requests = []
+
+    def serve():
+        # Respond to the first request, then drop the connection after receiving the second one.
+        conn, _ = listener.accept()
+        requests.append(daemon._recv_frame(conn))
+        daemon._send_frame(conn, (True, 1))
+        requests.append(daemon._recv_frame(conn))
+        conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    proxy = daemon.connect_instance(address, 'instance')
+    assert proxy.inc() == 1
+    # The request might have been dispatched, so it's not retried.
+    with pytest.raises(EOFError):
+        proxy.inc()
+    thread.join()
+    listener.close()
+    assert len(requests) == 2
+
+
+def _consume_and_exit(address):
+    proxy = daemon.connect_instance(address, 'instance')
+    gen = proxy.count(1000)
+    next(gen)
+    os._exit(0)
+
+
+def test_generator_closed_with_connection(unix_server):
+    import multiprocessing
+    import time
+
+    procs = [
+            multiprocessing.Process(target=_consume_and_exit, args=(unix_server.address,))
+            for _ in range(3)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+    # The generators of the dead clients are closed with their connections.
+    begin = time.monotonic()
+    while unix_server.generators and time.monotonic() - begin < 5:
+        time.sleep(0.05)
+    assert not unix_server.generators
+
+    # The connection is pinned during the iteration, and released once done.
+    proxy = daemon.connect_instance(unix_server.address, 'instance', generator_chunksize=8)
+    gen = proxy.count(20)
+    assert next(gen) == 0
+    assert not proxy._crw_pool.idle
+    assert proxy.get() == 42
+    assert list(gen) == list(range(1, 20))
+    assert not unix_server.generators
+    assert len(proxy._crw_pool.idle) == 2
+
+
+def test_generator_close_without_waiting(unix_server):
+    import gc
+    import time
+
+    proxy = daemon.connect_instance(unix_server.address, 'instance')
+    gen_del = proxy.count(1000)
+    gen_close = proxy.count(1000)
+    assert next(gen_del) == 0
+    assert next(gen_close) == 0
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(proxy.slow, 2)
+        time.sleep(0.5)
+
+        # Neither waits for the busy instance.
+        begin = time.monotonic()
+        del gen_del
+        gc.collect()
+        gen_close.close()
+        assert time.monotonic() - begin < 1
+        future.result()
+
+    begin = time.monotonic()
+    while unix_server.generators and time.monotonic() - begin < 5:
+        time.sleep(0.05)
+    assert not unix_server.generators
+    assert proxy.get() == 42
+
+
+def test_unix_socket_not_supported(tmp_path, monkeypatch):
+    monkeypatch.setattr(daemon, '_ThreadingUnixStreamServer', None)
+    server = daemon.CleanroomServer(str(tmp_path / 'cleanroom.sock'))
+    with pytest.raises(ValueError):
+        server.start()
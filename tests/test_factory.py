@@ -2,9 +2,10 @@ import os
 import gc
 from multiprocessing import Pool
 import queue
+import pstats
 from concurrent.futures import ThreadPoolExecutor
 import pytest
-from cleanroom import factory
+from cleanroom import factory, cpu, profiling, shared, subinterpreter, worker
 
 
 class DummyClass:
@@ -51,6 +52,100 @@ class DummyClass:
             raise ValueError('boom!')
         return num
 
+    def slow_echo(self, num, sleep):
+        import time
+        time.sleep(sleep)
+        return num
+
+    def slow_inc(self, sleep):
+        import time
+        self.num += 1
+        time.sleep(sleep)
+        return self.num
+
+    def slow_count(self, num, sleep):
+        import time
+        time.sleep(sleep)
+        return (idx for idx in range(num))
+
+    def slow_boom(self, sleep):
+        import time
+        time.sleep(sleep)
+        raise ValueError('boom!')
+
+    def affinity(self):
+        import os
+        return os.sched_getaffinity(0)
+
+    def omp_num_threads(self):
+        import os
+        return os.getenv('OMP_NUM_THREADS')
+
+    def count(self, num):
+        for idx in range(num):
+            self.num = idx
+            yield idx
+
+
+class DummyClassStateHook:
+
+    def __init__(self, num=0):
+        self.num = num
+        self.cache = [num] * 10
+
+    def __getstate__(self):
+        return {'num': self.num}
+
+    def __setstate__(self, state):
+        self.num = state['num']
+        self.cache = [self.num] * 10
+
+    def get(self):
+        return self.num, len(self.cache)
+
+    def pid(self):
+        import os
+        return os.getpid()
+
+    def corrupt(self):
+        self.num = lambda: None
+
+
+class DummyClassSharedResource:
+
+    def __init__(self, table, array=None):
+        self.table = table
+        self.array = array
+
+    def table_slice(self, begin, end):
+        return bytes(self.table[begin:end])
+
+    def table_readonly(self):
+        return self.table.readonly
+
+    def array_sum(self):
+        return float(self.array.sum()), self.array.shape, self.array.flags.writeable
+
+
+class DummyClassSlots:
+    __slots__ = ('num',)
+
+    def __init__(self, num):
+        self.num = num
+
+    def get(self):
+        return self.num
+
+
+class DummyClassUnpicklableState:
+
+    def __init__(self):
+        self.callback = lambda: None
+
+    def pid(self):
+        import os
+        return os.getpid()
+
 
 class DummyClassCorruptedInit:
 
@@ -104,7 +199,7 @@ def test_create_proc_channel_exception():
     in_queue.put(('boom', (), {}))
     good, out = out_queue.get()
     assert not good
-    assert isinstance(out, factory.ExceptionWrapper)
+    assert isinstance(out, worker.ExceptionWrapper)
     proc.join()
     assert not proc.is_alive()
 
@@ -222,3 +317,605 @@ def test_batch_random_access_scheduler():
 
     all_pids = set(scheduler.pid([factory.CleanroomArgs()] * 1000))
     assert len(all_pids) == 5
+
+
+def test_generator():
+    proxy = factory.create_instance(DummyClass, generator_chunksize=3)
+
+    assert list(proxy.count(10)) == list(range(10))
+    assert list(proxy.count(0)) == []
+
+    # Items are pulled lazily chunk by chunk.
+    gen = proxy.count(10)
+    assert next(gen) == 0
+    assert proxy.get() == 2
+    assert [next(gen) for _ in range(3)] == [1, 2, 3]
+    assert proxy.get() == 5
+
+    # Closing stops the remote generator.
+    gen.close()
+    assert list(gen) == []
+    assert proxy.get() == 5
+
+
+def test_generator_under_scheduler():
+    scheduler = factory.create_scheduler(2)
+    factory.create_instances_under_scheduler(scheduler, DummyClass, generator_chunksize=4)
+    assert list(scheduler.count(100)) == list(range(100))
+
+
+def test_backend():
+    with pytest.raises(ValueError):
+        factory.create_instance(DummyClass, backend='undefined')
+    with pytest.raises(ValueError):
+        factory.create_scheduler(2, backend='undefined')
+
+
+@pytest.mark.skipif(subinterpreter.interpreters is not None, reason='subinterpreter is available.')
+def test_subinterpreter_backend_fallback():
+    proxy = factory.create_instance(DummyClass, backend='subinterpreter')
+    assert proxy.pid() != os.getpid()
+
+    scheduler = factory.create_scheduler(2, backend='subinterpreter')
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+    assert len(set(scheduler.pid() for _ in range(100))) == 2
+
+
+@pytest.mark.skipif(subinterpreter.interpreters is None, reason='subinterpreter is not available.')
+def test_subinterpreter_backend():
+    proxy = factory.create_instance(DummyClass, factory.CleanroomArgs(42), backend='subinterpreter')
+    assert proxy.pid() == os.getpid()
+    assert proxy.get() == 42
+    proxy.inc()
+    assert proxy.get() == 43
+    assert list(proxy.count(10)) == list(range(10))
+    with pytest.raises(RuntimeError):
+        proxy.boom()
+
+
+class FakeInterpreter:
+
+    def __init__(self):
+        self.closed = False
+
+    def call(self, func, *args):
+        return func(*args)
+
+    def close(self):
+        self.closed = True
+
+
+def test_subinterpreter_close_busy(monkeypatch, caplog):
+    import logging
+    import queue
+    import time
+    import types
+
+    # Run the backend in a thread of the current interpreter.
+    monkeypatch.setattr(
+            subinterpreter,
+            'interpreters',
+            types.SimpleNamespace(
+                    create=FakeInterpreter,
+                    create_queue=lambda maxsize: queue.Queue(maxsize=maxsize),
+            ),
+    )
+    proxy = factory.create_instance(DummyClass, factory.CleanroomArgs(42), backend='subinterpreter')
+    assert proxy.get() == 42
+    proc = proxy._crw_proc
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(proxy.slow_inc, 4)
+        time.sleep(0.5)
+
+        # Cannot be interrupted, the close is bounded by the timeout anyway.
+        begin = time.monotonic()
+        with caplog.at_level(logging.WARNING):
+            factory.close(proxy, timeout=0.5)
+        assert time.monotonic() - begin < 3
+        assert 'cannot be interrupted' in caplog.text
+        assert proc in subinterpreter._ALIVE_CLEANROOM_INTERPRETERS
+        assert not proc.interpreter.closed
+
+        assert future.result() == 43
+
+    # Closed once the in-flight call returns.
+    proc.join(5)
+    assert proc.interpreter.closed
+    assert proc not in subinterpreter._ALIVE_CLEANROOM_INTERPRETERS
+
+
+def test_profiling():
+    proxy = factory.create_instance(DummyClass)
+
+    # Not started.
+    assert not profiling.stop_profiling(proxy).stats
+
+    assert profiling.start_profiling(proxy)
+    assert profiling.start_profiling(proxy)
+    proxy.echo(42)
+    proxy.pid(sleep=0.1)
+    stats = profiling.stop_profiling(proxy)
+    funcs = {func for _, _, func in stats.stats}
+    assert {'echo', 'pid'} <= funcs
+
+    # The serving is not interrupted.
+    assert proxy.echo(42) == 42
+
+
+def test_profiling_under_scheduler():
+    scheduler = factory.create_scheduler(3)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+
+    assert profiling.start_profiling(scheduler)
+    for _ in range(30):
+        scheduler.echo(42)
+    stats = profiling.stop_profiling(scheduler)
+
+    ncalls = [nc for (_, _, func), (_, nc, _, _, _) in stats.stats.items() if func == 'echo']
+    assert sum(ncalls) == 30
+
+    stats = profiling.profile(scheduler, duration=0.1)
+    assert isinstance(stats, pstats.Stats)
+
+
+def test_cpu_affinity_and_thread_limit():
+    cpus = cpu.get_available_cpus()
+
+    proxy = factory.create_instance(DummyClass, cpu_affinity=cpus[:1], thread_limit=2)
+    assert proxy.affinity() == set(cpus[:1])
+    assert proxy.omp_num_threads() == '2'
+
+    with pytest.raises(ValueError):
+        factory.create_instance(DummyClass, cpu_affinity=[])
+    with pytest.raises(ValueError):
+        factory.create_instance(DummyClass, thread_limit=0)
+    with pytest.raises(ValueError):
+        factory.create_instance(DummyClass, thread_limit='auto')
+    with pytest.raises(ValueError):
+        factory.create_instance(DummyClass, cpu_affinity='numa')
+
+
+def test_cpu_affinity_under_scheduler():
+    cpus = cpu.get_available_cpus()
+
+    for strategy in ('auto', 'numa'):
+        scheduler = factory.create_scheduler(2)
+        factory.create_instances_under_scheduler(
+                scheduler,
+                DummyClass,
+                cpu_affinity=strategy,
+                thread_limit='auto',
+        )
+        for proxy in factory.get_instances_under_scheduler(scheduler):
+            assert proxy.affinity() <= set(cpus)
+            assert int(proxy.omp_num_threads()) == len(proxy.affinity())
+
+    scheduler = factory.create_scheduler(2)
+    with pytest.raises(ValueError):
+        factory.create_instances_under_scheduler(scheduler, DummyClass, cpu_affinity=[cpus])
+
+
+def test_plan_cpu_affinity():
+    assert cpu._parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert cpu._split_cpus([0, 1, 2, 3], 2) == [{0, 1}, {2, 3}]
+    assert cpu._split_cpus([0, 1], 3) == [{0}, {1}, {0}]
+
+
+def test_close():
+    with factory.create_instance(DummyClass) as proxy:
+        pid = proxy.pid()
+    assert not check_pid(pid)
+    with pytest.raises(RuntimeError):
+        proxy.pid()
+
+    # Idempotent.
+    factory.close(proxy)
+
+    with factory.create_scheduler(4) as scheduler:
+        factory.create_instances_under_scheduler(scheduler, DummyClass)
+        pids = set(scheduler.pid() for _ in range(100))
+    assert not any(map(check_pid, pids))
+
+
+def test_close_drain():
+    proxy = factory.create_instance(DummyClass)
+    pid = proxy.pid()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(proxy.pid, sleep=1)
+        import time
+        time.sleep(0.2)
+        factory.close(proxy, timeout=10)
+        assert future.result() == pid
+    assert not check_pid(pid)
+
+
+def test_close_deadline():
+    import time
+
+    scheduler = factory.create_scheduler(4)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+    pids = [proxy.pid() for proxy in factory.get_instances_under_scheduler(scheduler)]
+
+    pool = ThreadPoolExecutor(max_workers=4)
+    for proxy in factory.get_instances_under_scheduler(scheduler):
+        pool.submit(proxy.pid, sleep=30)
+    time.sleep(0.2)
+
+    begin = time.monotonic()
+    factory.close(scheduler, timeout=1)
+    assert time.monotonic() - begin < 5
+    assert not any(map(check_pid, pids))
+    pool.shutdown(wait=False)
+
+
+def test_snapshot(tmp_path):
+    path = tmp_path / 'snapshot.pkl'
+
+    proxy = factory.create_instance(DummyClass, factory.CleanroomArgs(42))
+    proxy.inc()
+    factory.save_snapshot(proxy, path)
+    assert path.exists()
+
+    # Restored instead of running __init__.
+    restored = factory.create_instance(
+            DummyClass,
+            factory.CleanroomArgs(sleep=30),
+            timeout=10,
+            snapshot_path=path,
+    )
+    assert restored.get() == 43
+
+
+def test_snapshot_state_hook(tmp_path):
+    path = tmp_path / 'snapshot.pkl'
+
+    proxy = factory.create_instance(DummyClassStateHook, factory.CleanroomArgs(42))
+    factory.save_snapshot(proxy, path)
+    restored = factory.create_instance(DummyClassStateHook, snapshot_path=path)
+    assert restored.get() == (42, 10)
+
+    # Failed to pickle the state, the instance is still serving.
+    proxy.corrupt()
+    import pickle
+    with pytest.raises((pickle.PicklingError, AttributeError)):
+        factory.save_snapshot(proxy, tmp_path / 'broken.pkl')
+    assert proxy.pid()
+    assert not (tmp_path / 'broken.pkl').exists()
+
+
+def test_snapshot_under_scheduler(tmp_path):
+    path = tmp_path / 'snapshot.pkl'
+
+    scheduler = factory.create_scheduler(3)
+    factory.create_instances_under_scheduler(
+            scheduler,
+            DummyClass,
+            factory.CleanroomArgs(42),
+            snapshot_path=path,
+    )
+    assert path.exists()
+    assert set(scheduler.get() for _ in range(100)) == {42}
+
+    scheduler = factory.create_scheduler(3)
+    factory.create_instances_under_scheduler(
+            scheduler,
+            DummyClass,
+            factory.CleanroomArgs(sleep=30),
+            timeout=10,
+            snapshot_path=path,
+    )
+    assert set(scheduler.get() for _ in range(100)) == {42}
+
+
+def test_single_flight():
+    scheduler = factory.create_scheduler(1, single_flight=True)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        outs = list(pool.map(lambda _: scheduler.slow_inc(1), range(10)))
+    assert outs == [1] * 10
+    assert scheduler.get() == 1
+
+    # Not retained.
+    assert scheduler.slow_inc(0) == 2
+    assert scheduler.slow_inc(0) == 3
+
+    # Unhashable arguments.
+    assert scheduler.echo([1]) == [1]
+
+    # Exception is shared as well.
+    def call_boom(_):
+        with pytest.raises(ValueError):
+            scheduler.slow_boom(1)
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        futures = [pool.submit(call_boom, None) for _ in range(10)]
+        for future in futures:
+            future.result()
+
+
+def test_single_flight_typed():
+    scheduler = factory.create_scheduler(2, single_flight=True)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+
+    # Equal but of different types, not shared.
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        outs = list(
+                pool.map(lambda num: scheduler.slow_echo(num, sleep=0.5), [1, True, 1.0, True]))
+    assert [type(out) for out in outs] == [int, bool, float, bool]
+
+
+def test_single_flight_disabled():
+    scheduler = factory.create_scheduler(1)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        outs = list(pool.map(lambda _: scheduler.slow_inc(0.1), range(5)))
+    assert sorted(outs) == [1, 2, 3, 4, 5]
+
+
+def test_shared_resource(tmp_path):
+    resource = shared.create_shared_resource(b'hello world')
+    proxy = factory.create_instance(DummyClassSharedResource, factory.CleanroomArgs(resource))
+    assert proxy.table_slice(0, 5) == b'hello'
+    assert proxy.table_readonly()
+
+    path = tmp_path / 'table.bin'
+    path.write_bytes(b'0123456789')
+    resource = shared.create_shared_resource(path)
+    proxy = factory.create_instance(DummyClassSharedResource, factory.CleanroomArgs(table=resource))
+    assert proxy.table_slice(2, 4) == b'23'
+
+    # Not owned, the file is not removed.
+    resource.release()
+    assert path.exists()
+
+    resource = shared.create_shared_resource(str(path))
+    proxy = factory.create_instance(DummyClassSharedResource, factory.CleanroomArgs(resource))
+    assert proxy.table_slice(0, 3) == b'012'
+    resource.release()
+    assert path.exists()
+
+    with pytest.raises(TypeError):
+        shared.create_shared_resource(42)
+
+
+def test_shared_resource_under_scheduler():
+    numpy = pytest.importorskip('numpy')
+
+    scheduler = factory.create_scheduler(3)
+    table = shared.register_shared_resource(scheduler, b'')
+    array = shared.register_shared_resource(scheduler, numpy.arange(12, dtype='f8').reshape(3, 4))
+    factory.create_instances_under_scheduler(
+            scheduler,
+            DummyClassSharedResource,
+            factory.CleanroomArgs(table, array=array),
+    )
+    for proxy in factory.get_instances_under_scheduler(scheduler):
+        assert proxy.table_slice(0, 1) == b''
+        assert proxy.array_sum() == (66.0, (3, 4), False)
+
+    factory.close(scheduler)
+    assert not os.path.exists(table.path)
+    assert not os.path.exists(array.path)
+
+
+def test_instances_per_process():
+    import time
+
+    scheduler = factory.create_scheduler(5, instances_per_process=2)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+    proxies = factory.get_instances_under_scheduler(scheduler)
+    assert len(proxies) == 5
+
+    pids = [proxy.pid() for proxy in proxies]
+    assert len(set(pids)) == 3
+    assert pids[0] == pids[1]
+    assert set(scheduler.pid() for _ in range(1000)) == set(pids)
+
+    # Addressed individually.
+    proxies[0].inc()
+    assert proxies[0].get() == 1
+    assert proxies[1].get() == 0
+
+    # Dispatched by threads.
+    begin = time.monotonic()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        list(pool.map(lambda p: p.pid(sleep=1), proxies[:2]))
+    assert time.monotonic() - begin < 1.8
+
+    # A failed instance does not stop the co-hosted ones.
+    with pytest.raises(RuntimeError):
+        proxies[0].boom()
+    with pytest.raises(RuntimeError):
+        proxies[0].get()
+    assert proxies[1].get() == 0
+
+    factory.close(proxies[1])
+    assert check_pid(pids[2])
+    factory.close(scheduler)
+    assert not any(map(check_pid, pids))
+
+
+def test_instances_per_process_error():
+    with pytest.raises(ValueError):
+        factory.create_scheduler(2, instances_per_process=0)
+
+    scheduler = factory.create_scheduler(2, instances_per_process=2)
+    with pytest.raises(ValueError):
+        factory.create_instances_under_scheduler(scheduler, DummyClassCorruptedInit)
+
+    # Validated before starting the process.
+    scheduler = factory.create_scheduler(2, instances_per_process=2)
+    with pytest.raises(ValueError):
+        factory.create_instances_under_scheduler(scheduler, DummyClass, cpu_affinity=[{0}, []])
+    with pytest.raises(ValueError):
+        factory.create_cohosted_instances(DummyClass, 2, cpu_affinities=[{0}])
+
+
+def test_instances_per_process_gc():
+    scheduler = factory.create_scheduler(2, instances_per_process=2)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+    proxies = factory.get_instances_under_scheduler(scheduler)
+    pid = proxies[0].pid()
+
+    proxy = proxies.pop()
+    del proxy
+    gc.collect()
+    assert proxies[0].pid() == pid
+
+    del scheduler, proxies
+    gc.collect()
+    assert not check_pid(pid)
+
+
+def test_generator_del_without_blocking():
+    proxy = factory.create_instance(DummyClass, generator_chunksize=3)
+    gen = proxy.count(10)
+    assert next(gen) == 0
+
+    # Simulate GC in the thread holding the lock.
+    proxy._crw_lock.acquire()
+    try:
+        gen.__del__()
+    finally:
+        proxy._crw_lock.release()
+    assert gen.done
+
+    assert proxy.echo(42) == 42
+    assert list(proxy.count(5)) == list(range(5))
+
+
+def test_profiling_skip_dead_instances():
+    scheduler = factory.create_scheduler(3)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+    proxies = factory.get_instances_under_scheduler(scheduler)
+
+    with pytest.raises(RuntimeError):
+        proxies[0].boom()
+    factory.close(proxies[1])
+
+    assert profiling.start_profiling(scheduler)
+    for _ in range(5):
+        proxies[2].echo(42)
+    stats = profiling.stop_profiling(scheduler)
+
+    ncalls = [nc for (_, _, func), (_, nc, _, _, _) in stats.stats.items() if func == 'echo']
+    assert sum(ncalls) == 5
+
+    # Stopped for the healthy instance.
+    assert not profiling.stop_profiling(proxies[2]).stats
+
+
+def test_profiling_skip_timeout_instances():
+    scheduler = factory.create_scheduler(2)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+    proxies = factory.get_instances_under_scheduler(scheduler)
+
+    assert profiling.start_profiling(scheduler)
+    for proxy in proxies:
+        proxy.echo(42)
+
+    def timeout(name, *args):
+        raise factory.TimeoutException(f'{name} timeout')
+
+    proxies[0]._crw_control_call = timeout
+    stats = profiling.stop_profiling(scheduler)
+
+    # The stats of the others are not lost.
+    ncalls = [nc for (_, _, func), (_, nc, _, _, _) in stats.stats.items() if func == 'echo']
+    assert sum(ncalls) == 1
+
+
+def test_snapshot_failure_under_scheduler(tmp_path):
+    path = tmp_path / 'snapshot.pkl'
+
+    scheduler = factory.create_scheduler(3)
+    factory.create_instances_under_scheduler(
+            scheduler,
+            DummyClassUnpicklableState,
+            snapshot_path=path,
+    )
+    assert not path.exists()
+    assert len(set(scheduler.pid() for _ in range(100))) == 3
+
+
+def test_single_flight_generator():
+    scheduler = factory.create_scheduler(1, single_flight=True)
+    factory.create_instances_under_scheduler(scheduler, DummyClass)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        gens = list(pool.map(lambda _: scheduler.slow_count(20, 1), range(4)))
+        lengths = list(pool.map(lambda gen: len(list(gen)), gens))
+    assert len(set(map(id, gens))) == 4
+    assert lengths == [20] * 4
+
+
+def test_shared_resource_pickle():
+    import pickle
+
+    resource = shared.create_shared_resource(b'hello')
+    copied = pickle.loads(pickle.dumps(resource))
+    assert not copied.owned
+    del copied
+    gc.collect()
+    assert os.path.exists(resource.path)
+    assert bytes(resource.attach()) == b'hello'
+
+    resource.release()
+    assert not os.path.exists(resource.path)
+
+
+def test_shared_resource_with_snapshot(tmp_path):
+    numpy = pytest.importorskip('numpy')
+
+    path = str(tmp_path / 'snapshot.pkl')
+    scheduler = factory.create_scheduler(3)
+    table = shared.register_shared_resource(scheduler, b'x' * 100)
+    array = shared.register_shared_resource(scheduler, numpy.arange(100000, dtype='f8'))
+    factory.create_instances_under_scheduler(
+            scheduler,
+            DummyClassSharedResource,
+            factory.CleanroomArgs(table, array=array),
+            snapshot_path=path,
+    )
+    for proxy in factory.get_instances_under_scheduler(scheduler):
+        assert proxy.table_slice(0, 2) == b'xx'
+        assert proxy.table_readonly()
+        assert proxy.array_sum() == (float(sum(range(100000))), (100000,), False)
+
+    # Only the handles are stored in the snapshot.
+    assert os.path.getsize(path) < 100000
+
+    factory.close(scheduler)
+    assert not os.path.exists(table.path)
+    assert not os.path.exists(array.path)
+
+
+def test_snapshot_slots(tmp_path):
+    path = tmp_path / 'snapshot.pkl'
+
+    proxy = factory.create_instance(DummyClassSlots, factory.CleanroomArgs(42))
+    factory.save_snapshot(proxy, path)
+    restored = factory.create_instance(DummyClassSlots, snapshot_path=path)
+    assert restored.get() == 42
+
+
+def test_snapshot_skip_dead_instances(tmp_path):
+    path = tmp_path / 'snapshot.pkl'
+
+    scheduler = factory.create_scheduler(2)
+    factory.create_instances_under_scheduler(scheduler, DummyClass, factory.CleanroomArgs(42))
+    proxies = factory.get_instances_under_scheduler(scheduler)
+    with pytest.raises(RuntimeError):
+        proxies[0].boom()
+
+    factory.save_snapshot(scheduler, path)
+    restored = factory.create_instance(DummyClass, snapshot_path=path)
+    assert restored.get() == 42
+
+    with pytest.raises(RuntimeError):
+        proxies[1].boom()
+    with pytest.raises(RuntimeError):
+        factory.save_snapshot(scheduler, tmp_path / 'none.pkl')